@@ -0,0 +1,178 @@
+# Local SQLite cache of message metadata between sync runs, and the
+# in-memory table the sync loop works on.
+# ------------------------------------------------------------------
+
+import array
+import hashlib
+import sqlite3
+
+
+def hashMessageId(msgid):
+    """8-byte integer digest of a Message-ID, used as the dedup map key.
+
+    Int keys cost 8 bytes and one u64 hash per lookup instead of the
+    60-120 byte header string; the raw id stays in the value for logging
+    and the cache.
+    """
+    if not msgid:
+        return None
+
+    if isinstance(msgid, str):
+        msgid = msgid.encode('utf-8', 'surrogateescape')
+
+    return int.from_bytes(hashlib.blake2b(msgid, digest_size=8).digest(), 'big')
+
+
+class MsgTable:
+    """Structure-of-arrays table of per-message metadata.
+
+    A tuple (or dict) per message costs a few hundred bytes of PyObject
+    overhead; here uids and sizes live in packed array('Q') columns at
+    8 bytes per entry, with hash2idx mapping the Message-ID hash to a row
+    index. A same-id row arriving with another size replaces the stored
+    row, mirroring the former dict semantics.
+    """
+
+    __slots__ = ('hash2idx', 'flags', 'uids', 'sizes', 'raw_ids')
+
+    def __init__(self):
+        self.hash2idx = {}
+        self.flags = array.array('B')
+        self.uids = array.array('Q')
+        self.sizes = array.array('Q')
+        self.raw_ids = []
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __contains__(self, key):
+        return key in self.hash2idx
+
+    def add(self, key, flag, uid, size, raw_id):
+        uid = int(uid.decode() if isinstance(uid, (bytes, bytearray)) else uid)
+        idx = self.hash2idx.get(key)
+        if idx is None:
+            self.hash2idx[key] = len(self.uids)
+            self.flags.append(flag or 0)
+            self.uids.append(uid)
+            self.sizes.append(size or 0)
+            self.raw_ids.append(raw_id)
+        elif size != self.sizes[idx]:
+            self.flags[idx] = flag or 0
+            self.uids[idx] = uid
+            self.sizes[idx] = size or 0
+            self.raw_ids[idx] = raw_id
+
+    def update(self, other):
+        for key, idx in other.hash2idx.items():
+            self.add(key, other.flags[idx], other.uids[idx],
+                     other.sizes[idx], other.raw_ids[idx])
+
+    def uidOf(self, key):
+        idx = self.hash2idx.get(key)
+        return self.uids[idx] if idx is not None else None
+
+
+class MessageIdCache:
+    """SQLite cache of destination message ids per (user, folder).
+
+    Rows are valid only while the folder keeps its UIDVALIDITY; on a match a
+    repeat run loads the map from disk and only fetches headers of UIDs added
+    since the cached UIDNEXT, turning the O(folder size) re-scan into
+    O(new messages). WAL with synchronous=NORMAL keeps writers from blocking
+    the concurrent readers of other folder tasks.
+    """
+
+    def __init__(self, path):
+        # pool entries move between worker threads, but the connection pool
+        # hands each cache to one thread at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS folder_state ('
+                        'user TEXT, folder TEXT, uidvalidity INTEGER, uidnext INTEGER, '
+                        'PRIMARY KEY (user, folder))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS message_ids ('
+                        'user TEXT, folder TEXT, uid INTEGER, msgid TEXT, flag TEXT, size INTEGER, '
+                        'PRIMARY KEY (user, folder, uid))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sync_state ('
+                        'user TEXT, folder TEXT, '
+                        'src_uidvalidity INTEGER, src_uidnext INTEGER, src_modseq INTEGER, '
+                        'dst_uidvalidity INTEGER, dst_uidnext INTEGER, dst_modseq INTEGER, '
+                        'PRIMARY KEY (user, folder))')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def getSyncState(self, user, folder):
+        """STATUS snapshot of both sides after the last clean sync.
+
+        Returns (src uidvalidity, uidnext, modseq, dst uidvalidity,
+        uidnext, modseq) or None; a live STATUS pair matching it means the
+        folder needs no work at all, not even a SELECT.
+        """
+        return self.db.execute(
+            'SELECT src_uidvalidity, src_uidnext, src_modseq, '
+            'dst_uidvalidity, dst_uidnext, dst_modseq FROM sync_state '
+            'WHERE user=? AND folder=?', (user, folder)).fetchone()
+
+    def saveSyncState(self, user, folder, src_status, dst_status):
+        """Record the STATUS dicts of both sides for the skip check."""
+        self.db.execute(
+            'INSERT OR REPLACE INTO sync_state (user, folder, '
+            'src_uidvalidity, src_uidnext, src_modseq, '
+            'dst_uidvalidity, dst_uidnext, dst_modseq) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (user, folder,
+             src_status.get('UIDVALIDITY'), src_status.get('UIDNEXT'),
+             src_status.get('HIGHESTMODSEQ'),
+             dst_status.get('UIDVALIDITY'), dst_status.get('UIDNEXT'),
+             dst_status.get('HIGHESTMODSEQ')))
+        self.db.commit()
+
+    def findMessage(self, user, msgid, size, exclude_folder):
+        """Locate a message by id and size in another cached folder.
+
+        Returns (folder, uid) or None; used by the same_server_move path
+        to relocate a message instead of re-uploading its body.
+        """
+        return self.db.execute(
+            'SELECT folder, uid FROM message_ids '
+            'WHERE user=? AND msgid=? AND size=? AND folder!=? LIMIT 1',
+            (user, msgid, size, exclude_folder)).fetchone()
+
+    def getFolderState(self, user, folder):
+        return self.db.execute('SELECT uidvalidity, uidnext FROM folder_state '
+                               'WHERE user=? AND folder=?', (user, folder)).fetchone()
+
+    def loadMessages(self, user, folder):
+        """Load the MsgTable of a folder from the cache."""
+        message_ids = MsgTable()
+        rows = self.db.execute('SELECT uid, msgid, flag, size FROM message_ids '
+                               'WHERE user=? AND folder=?', (user, folder))
+        for uid, msgid, flag, size in rows:
+            # rows written before flags became a bitmask hold text; treat
+            # them as flagless so they are refreshed on the next STORE
+            if not isinstance(flag, int):
+                flag = 0
+            message_ids.add(hashMessageId(msgid), flag, uid, size, msgid)
+
+        return message_ids
+
+    def replaceFolder(self, user, folder, uidvalidity, uidnext, message_ids):
+        rows = []
+        for idx, msgid in enumerate(message_ids.raw_ids):
+            # messages without a Message-ID are kept too (msgid NULL):
+            # dropping them would re-append the None entry on every
+            # cache-hit run
+            rows.append((user, folder, message_ids.uids[idx], msgid or None,
+                         message_ids.flags[idx], message_ids.sizes[idx]))
+
+        self.db.execute('DELETE FROM message_ids WHERE user=? AND folder=?', (user, folder))
+        self.db.executemany('INSERT OR REPLACE INTO message_ids '
+                            '(user, folder, uid, msgid, flag, size) VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.execute('INSERT OR REPLACE INTO folder_state '
+                        '(user, folder, uidvalidity, uidnext) VALUES (?, ?, ?, ?)',
+                        (user, folder, uidvalidity, uidnext))
+        self.db.commit()
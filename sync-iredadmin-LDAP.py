@@ -1,1059 +1,2231 @@
-#!/usr/bin/env python3
-# Author: Alexandr Maievsky <softstar2004@gmail.com>
-# Purpose: Synchronization domains and mails of two iredadmin servers with LDAP backend.
-#
-# Usage:
-#   write setting access to ldap server to setting.py, example setting.py.exampl
-#   python MigrateUserLDAP.py
-# ------------------------------------------------------------------
-
-import warnings
-from cryptography.utils import CryptographyDeprecationWarning
-with warnings.catch_warnings():
-    warnings.filterwarnings('ignore', category=CryptographyDeprecationWarning)
-
-import argparse
-import imaplib
-import re
-import socket
-import sys
-import time
-import ssl
-import ldap3
-from ldap3 import Server, Connection, ALL
-import email
-import datetime
-import settings
-import concurrent.futures
-import functools
-import logging
-import asyncssh
-
-# Default groups which will be created while create a new domain.
-# WARNING: Don't use unicode string here.
-DEFAULT_GROUPS = ('Users', 'Groups', 'Aliases', 'Externals')
-LDAP_SEARCH_ALL_DOMAINS = '(&(objectClass=mailDomain)(!(accountStatus=disabled))(enabledService=mail))'
-LDAP_SEARCH_DOMAIN = '(&(objectClass=mailDomain)(!(accountStatus=disabled))(enabledService=mail)(domainName={dN}))'
-LDAP_SEARCH_ALL_USERS = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail))'
-LDAP_SEARCH_USERS_DOMAIN = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail)(mail=*@{dM}))'
-LDAP_SEARCH_ALL_GROUP_DOMAIN = '(&(objectClass=organizationalUnit))'
-LDAP_SEARCH_USER = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail)(mail={uMail}))'
-DOMAIN_ATTRS_ALL = (
-    # Normal attributes.
-    'domainName', 'domainPendingAliasName', 'domainAliasName',
-    'cn', 'description', 'accountStatus', 'domainBackupMX',
-    'domainAdmin', 'mtaTransport', 'enabledService',
-    'domainRecipientBccAddress', 'domainSenderBccAddress',
-    'senderRelayHost', 'disclaimer',
-    'domainCurrentQuotaSize',
-    # 'domainCurrentUserNumber',
-    # 'domainCurrentListNumber',
-    # 'domainCurrentAliasNumber',
-    'accountSetting',
-)
-USER_ATTRS_SYNC = (
-    'mail', 'cn', 'sn', 'uid', 'accountStatus', 'mailQuota',
-    'employeeNumber', 'title', 'senderRelayHost',
-    'shadowAddress', 'mailForwardingAddress', 'memberOfGroup',
-    'enabledService', 'disabledService',
-    'domainGlobalAdmin',  # Global admin
-    'shadowLastChange',  # Password last change, it's number of days since
-    'givenName',
-    'mobile', 'telephoneNumber', 'preferredLanguage', 'memberOfGroup',
-    'userRecipientBccAddress', 'userSenderBccAddress',
-    'mtaTransport',
-    'accountSetting',
-    'allowNets',
-    'street',
-    'postalCode',
-    'postalAddress',
-)
-USER_ATTRS_ALL = tuple(list(USER_ATTRS_SYNC) + [
-    'storageBaseDirectory', 'mailMessageStore', 'homeDirectory'
-])
-
-# Email address.
-RE_EMAIL_TEST = r"""[\w\-\#][\w\-\.\+\=\/\&\#]*@[\w\-][\w\-\.]*\.[a-zA-Z0-9\-]{2,15}"""
-cmp_email = re.compile(r"^" + RE_EMAIL_TEST + r"$", re.IGNORECASE | re.DOTALL)
-PATERN_SIZE_MAIL = r'RFC822.SIZE\s(.*?)\s'
-cmp_size_mail = re.compile(PATERN_SIZE_MAIL)
-
-# IGNORED FLAGS MAIL
-IGNORED_FLAGS_MAIL = r'\\RECENT \\NONJUNK \\JUNK'
-
-# logger
-# logging.basicConfig(filename='sync-iredadmin.log', encoding='utf-8', level=logging.INFO)
-FORMATTER_LOG = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-
-logger = logging.getLogger('sync')
-logger.setLevel(logging.DEBUG)
-
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-ch.setFormatter(FORMATTER_LOG)
-logger.addHandler(ch)
-
-fh = logging.FileHandler(filename='sync-iredadmin.log', encoding='utf-8')
-fh.setLevel(logging.INFO)
-fh.setFormatter(FORMATTER_LOG)
-logger.addHandler(fh)
-
-
-class ProviderSSH:
-
-    def __init__(self):
-        self.connect_ssh = None
-        self.listener = None
-        self.listen_port = None
-        self.is_connected = False
-
-    def __del__(self):
-        if self.is_connected:
-            self.connect_ssh.close()
-            self.connect_ssh = None
-            self.listener = None
-            self.listen_port = None
-
-    def connect(self, setting_connect):
-        param_connect = setting_connect.get('over_ssh')
-        server = param_connect.get('server')
-        port = param_connect.get('port')
-        username = param_connect.get('username')
-        pwd = param_connect.get('pwd')
-        privKey = param_connect.get('privkey')
-
-        self.is_connected = False
-        try:
-            if pwd:
-                self.connect_ssh = asyncssh.connect(server=server, port=port, username=username, password=pwd)
-            else:
-                self.connect_ssh = asyncssh.connect(server=server, port=port, username=username, client_keys=[privKey])
-
-            if self.connect_ssh:
-                server_dst = setting_connect.get('server')
-                port_dst = setting_connect.get('server')
-                self.listener = self.connect_ssh.forward_local_port('', 0, server_dst, port_dst)
-                self.listen_port = self.listener.get_port()
-                logger.info('SSH Listening %s on port %s', server_dst, str(self.listen_port))
-                self.is_connected = True
-            else:
-                logger.error('SSH Error connected to ssh server %s on port %s', server, str(port))
-
-        except socket.gaierror as e:
-            (err, desc) = e
-            logger.error("SSH ERROR: problem looking up server '%s' (%s %s)", server, err, desc)
-        except socket.error as e:
-            logger.error("SSH ERROR: could not connect to '%s' (%s)", server, str(e))
-        except Exception as e:
-            logger.error("SSH ERROR: Host %s. %s", server, str(e))
-
-        return self.is_connected
-
-    def getPort(self):
-        return self.listener.listen_port
-
-
-class LdapServer:
-
-    def __init__(self):
-        self.con = None
-        self.srvdn = ''
-        self.srvport = ''
-        self.use_ssl = False
-        self.baseDN = ''
-        self.bind_dn = ''
-        self.bind_password = ''
-        self.ssh_server = ''
-        self.ssh_port = None
-        self.ssh_username = ''
-        self.ssh_password = ''
-        self.privatekey = ''
-        self.provider_ssh = None
-
-    def __del__(self):
-        self.__disconnect()
-
-    def __str__(self):
-        if self.con:
-            return str(self.con)
-
-        return 'None connect'
-
-    def __disconnect(self):
-        if not self.con:
-            self.con.unbind()
-            self.con = None
-
-    def connect(self, setting_connect):
-        if not setting_connect:
-            logger.error('LDAP Error setting server connected')
-            return False, 'LDAP Error setting server connected'
-
-        over_ssh = setting_connect.get('over_ssh')
-        if over_ssh:
-            self.provider_ssh = ProviderSSH()
-            result_over_ssh = self.provider_ssh.connect(setting_connect)
-            if not result_over_ssh:
-                logger.warning('LDAP Warn error connected server SHH')
-                return False, 'Error connected server SSH'
-
-        self.srvdn = setting_connect.get('server')
-        if over_ssh:
-            self.srvport = self.provider_ssh.getPort()
-        else:
-            self.srvport = setting_connect.get('port')
-
-        self.baseDN = setting_connect.get('basedn')
-        self.bind_dn = setting_connect.get('bind_dn')
-        self.bind_password = setting_connect.get('bind_password')
-        self.use_ssl = setting_connect.get('use_ssl', False)
-        if not self.baseDN:
-            self.baseDN = self.__getBaseDNFromUser(self.bind_dn)
-
-        s = Server(self.srvdn, self.srvport, use_ssl=self.use_ssl, get_info=ALL)
-        if self.use_ssl:
-            self.con = Connection(s, user=self.bind_dn, password=self.bind_password, authentication=ldap3.SIMPLE)
-        else:
-            self.con = Connection(s, user=self.bind_dn, password=self.bind_password)
-
-        if not self.con.bind():
-            return False, self.con.result
-
-        return True,
-
-    @staticmethod
-    def __parceServerLDAP(param_server: str):
-        p = param_server.split(':')
-        if len(p) != 3:
-            logger.error('Error parameter server \'ldap[s]://[ip]:port\': {}'.format(param_server))
-            return None
-
-        use_ssl = False
-        if p[0] == 'ldaps':
-            use_ssl = True
-
-        srv = p[1].replace('//', '')
-        port = int(p[2])
-        return dict(server=srv, port=port, use_ssl=use_ssl)
-
-    @staticmethod
-    def __getBaseDNFromUser(user_name: str):
-        bDN = ''
-        p = user_name.split(',')
-        for dc in p:
-            if dc.find('dc=') != -1:
-                bDN += ',' + dc
-
-        return 'o=domains{dn}'.format(dn=bDN)
-
-    # region Domain
-    def getDomainList(self):
-        searchDN = self.baseDN
-        domain_list = self.con.extend.standard.paged_search(search_base=searchDN,
-                                                            search_filter=LDAP_SEARCH_ALL_DOMAINS,
-                                                            search_scope=ldap3.SUBTREE,
-                                                            attributes=DOMAIN_ATTRS_ALL,
-                                                            generator=False)
-        return domain_list
-
-    def getDomain(self, domain):
-        dn = self.baseDN
-        search_filter = LDAP_SEARCH_DOMAIN.format(dN=domain)
-        self.con.search(search_base=dn,
-                        search_filter=search_filter,
-                        search_scope=ldap3.LEVEL,
-                        attributes=DOMAIN_ATTRS_ALL,
-                        paged_size=5)
-        if self.con.result['description'] != 'success':
-            return []
-
-        return self.con.response
-
-    def addDomain(self, domain, attr):
-        dn = 'domainName={dN},{bDN}'.format(dN=domain, bDN=self.baseDN)
-        self.con.add(dn=dn, attributes=attr)
-        res = self.con.result['description'] == 'success'
-        if res:
-            # adding default group domain
-            for itemgroup in DEFAULT_GROUPS:
-                dng = 'ou={dG},domainName={dN},{bDN}'.format(dG=itemgroup, dN=domain, bDN=self.baseDN)
-                self.con.add(dn=dng, object_class='organizationalUnit')
-
-        return res
-
-    def updateDomain(self, domain, attr):
-        dn = 'domainName={dN},{bDN}'.format(dN=domain, bDN=self.baseDN)
-        self.con.modify(dn=dn, changes=attr)
-
-        return self.con.result['description'] == 'success'
-
-    def checkDomain(self, domain, attr):
-        dn = self.baseDN
-        search_filter = LDAP_SEARCH_DOMAIN.format(dN=domain)
-        self.con.search(search_base=dn,
-                        search_filter=search_filter,
-                        search_scope=ldap3.LEVEL,
-                        attributes=DOMAIN_ATTRS_ALL,
-                        paged_size=5)
-        if self.con.result['description'] != 'success':
-            return 'ERROR', 'Not search domain name {dN}'.format(dN=domain)
-
-        domains = self.con.response
-        if len(domains) == 0:
-            return 'ADD', domain, attr
-
-        dm = domains[0]
-        resDiff = self.__getDiffAttr(attr, dm['attributes'], DOMAIN_ATTRS_ALL, False)
-        if resDiff:
-            return 'NONE', domain, None
-
-        return 'MODIFY', domain, resDiff
-
-    # endregion
-
-    def getUserList(self, domain='*'):
-        searchDN = self.baseDN
-        if domain == '*':
-            searchUser = LDAP_SEARCH_ALL_USERS
-        else:
-            searchUser = LDAP_SEARCH_USERS_DOMAIN.format(dM=domain)
-
-        users_list = self.con.extend.standard.paged_search(search_base=searchDN,
-                                                           search_filter=searchUser,
-                                                           search_scope=ldap3.SUBTREE,
-                                                           attributes=ldap3.ALL_ATTRIBUTES,
-                                                           generator=False)
-
-        return users_list
-
-    def getUser(self, user):
-        dn = self.baseDN
-        search_filter = LDAP_SEARCH_USER.format(uMail=user)
-        self.con.search(search_base=dn,
-                        search_filter=search_filter,
-                        search_scope=ldap3.LEVEL,
-                        attributes=ldap3.ALL_ATTRIBUTES,
-                        paged_size=5)
-        if self.con.result['description'] != 'success':
-            return []
-
-        return self.con.response
-
-    def checkUser(self, user_mail, attr):
-
-        if not self.is_email(user_mail):
-            return 'ERROR', 'Name user not valid'
-
-        segment_mail = user_mail.split('@')
-        domain = segment_mail[1]
-        dn = 'ou=Users,domainName={dN},{bDN}'.format(dN=domain, bDN=self.baseDN)
-        search_filter = LDAP_SEARCH_USER.format(uMail=user_mail)
-        self.con.search(search_base=dn,
-                        search_filter=search_filter,
-                        search_scope=ldap3.LEVEL,
-                        attributes=ldap3.ALL_ATTRIBUTES,
-                        paged_size=5)
-        if self.con.result['description'] != 'success':
-            return 'ERROR', 'Not search user name {dN}'.format(dN=user_mail)
-
-        users = self.con.response
-        if len(users) == 0:
-            return 'ADD', user_mail, attr
-
-        usr = users[0]
-        resDiff = self.__getDiffAttr(attr, usr['attributes'], USER_ATTRS_SYNC, False)
-        if not resDiff:
-            return 'NONE', user_mail
-
-        return 'MODIFY', user_mail, resDiff
-
-    def addUser(self, user_mail, attr, setting_account):
-
-        if not self.is_email(user_mail):
-            return 'ERROR', 'Name user not valid'
-
-        segment_mail = user_mail.split('@')
-
-        domain = segment_mail[1]
-        username = segment_mail[0]
-        dn = 'mail={uN},ou=Users,domainName={dN},{bDN}'.format(uN=user_mail, dN=domain, bDN=self.baseDN)
-
-        # add attributes directory new server
-        storage_base_directory = setting_account.get('storage_mail_base_directory')
-        if not storage_base_directory:
-            logger.error('IMAP error add user {} Not setting storage base directory'.format(user_mail))
-            return False
-
-        # Get base directory and storage node.
-        std = storage_base_directory.rstrip('/').split('/')
-        dst_mail_message_store = std.pop()
-        dst_storage_base = '/'.join(std)
-
-        # maildir_domain = str(domain).lower()
-        index_str, str1 = self.__getNextChar(username)
-        str2 = str3 = str1
-        if len(username) >= 3:
-            index_str, str2 = self.__getNextChar(username, index_str)
-            index_str, str3 = self.__getNextChar(username, index_str)
-        elif len(username) == 2:
-            str2 = str3 = username[1]
-
-        timestamp_maildir = '-%s' % time.strftime('%Y.%m.%d.%H.%M.%S')
-        maildir_user = "%s/%s/%s/%s%s/" % (str1, str2, str3, username, timestamp_maildir,)
-
-        dst_home_directory = '{}/{}'.format(storage_base_directory, maildir_user)
-        dst_mail_message_store = '{}/{}'.format(dst_mail_message_store, maildir_user)
-        attr['homeDirectory'] = dst_home_directory
-        attr['mailMessageStore'] = dst_mail_message_store
-        attr['storageBaseDirectory'] = dst_storage_base
-
-        self.con.add(dn=dn, attributes=attr)
-        res = self.con.result['description'] == 'success'
-        return res
-
-    def updateUser(self, user_mail, attr):
-        segment_mail = user_mail.split('@')
-
-        domain = segment_mail[1]
-        dn = 'mail={uN},ou=Users,domainName={dN},{bDN}'.format(uN=user_mail, dN=domain, bDN=self.baseDN)
-        self.con.modify(dn=dn, changes=attr)
-        res = self.con.result['description'] == 'success'
-        return res
-
-    @staticmethod
-    def __getNextChar(source_string, index=0):
-        i_len = len(source_string)
-        ret_str = source_string[index]
-        while index < i_len:
-            char_str = source_string[index]
-            if char_str not in ['.', '_', '-']:
-                ret_str = char_str
-                index += 1
-                break
-            index += 1
-
-        return index, ret_str
-
-    @staticmethod
-    def __getDiffAttr(src_attr, dst_attr, list_available_attr=None, delete_dst=False):
-        diffAttr = {}
-
-        for attr in src_attr:
-            if list_available_attr and attr not in list_available_attr:
-                continue
-
-            src_val = src_attr.get(attr)
-            if attr not in dst_attr:
-                if isinstance(src_val, list):
-                    diffAttr[attr] = [(ldap3.MODIFY_ADD, src_val)]
-                else:
-                    diffAttr[attr] = [(ldap3.MODIFY_ADD, [src_val])]
-            else:
-                dst_val = dst_attr.get(attr)
-                if isinstance(src_val, list):
-                    for item_src_val in src_val + dst_val:
-                        if item_src_val not in dst_val or item_src_val not in src_val:
-                            diffAttr[attr] = [(ldap3.MODIFY_REPLACE, src_val)]
-                            break
-                elif src_val != dst_val:
-                    diffAttr[attr] = [(ldap3.MODIFY_REPLACE, [src_val])]
-
-        if delete_dst:
-            for attr in dst_attr:
-                if attr not in src_attr:
-                    diffAttr[attr] = [(ldap3.MODIFY_DELETE, [])]
-
-        return diffAttr
-
-    def addGroupDomain(self, domain, group_name, group_object, attr):
-        dn = 'ou={gName},domainName={dN},{bDN}'.format(gName=group_name, dN=domain, bDN=self.baseDN)
-        self.con.add(dn=dn, object_class=group_object, attributes=attr)
-
-        return self.con.result
-
-    def getGroupDomain(self, domain):
-        searchDN = 'domainName={dN},{bDN}'.format(dN=domain, bDN=self.baseDN)
-        group_domain_list = self.con.extend.standard.paged_search(search_base=searchDN,
-                                                                  search_filter=LDAP_SEARCH_ALL_GROUP_DOMAIN,
-                                                                  search_scope=ldap3.LEVEL,
-                                                                  paged_size=100,
-                                                                  generator=False)
-
-        return group_domain_list
-
-    @staticmethod
-    def getDomainNameFromFullDN(full_dn):
-        items_dn = ldap3.utils.dn.parse_dn(full_dn)
-        for descrDn, valDn, spDn in items_dn:
-            if descrDn == 'domainName':
-                return valDn
-
-        return None
-
-    @staticmethod
-    def getUserMailNameFromFullDN(full_user_dn):
-        usr = ''
-        dn = ''
-        items_dn = ldap3.utils.dn.parse_dn(full_user_dn)
-        for descrDn, valDn, spDn in items_dn:
-            if descrDn == 'mail':
-                usr = valDn
-            elif descrDn == 'domainName':
-                dn = valDn
-
-        return dn, usr
-
-    @staticmethod
-    def is_email(s) -> bool:
-        try:
-            s = str(s).strip()
-        except UnicodeEncodeError:
-            return False
-
-        if cmp_email.match(s):
-            return True
-
-        return False
-
-
-class IMAPServer:
-
-    def __init__(self):
-        self.server = None
-        self.connect_imap = None
-        self.master_login = None
-        self.master_pwd = None
-
-    def __del__(self):
-        self.disconnect()
-
-    def disconnect(self):
-        if not self.connect_imap:
-            self.server = None
-            self.connect_imap = None
-
-    def connect(self, config):
-        self.disconnect()
-
-        l_timeout = float(config.get('timeout', 30))
-        l_server = config.get('server')
-        self.server = l_server
-        l_port = config.get('port', 143)
-        l_secure = config.get('secure', 'None')
-        self.master_login = config.get('master_usr')
-        self.master_pwd = config.get('master_pwd')
-
-        result_connect = False
-
-        try:
-            socket.setdefaulttimeout(l_timeout)
-            if 'SSL' in l_secure:
-                logger.info("Connecting to '%s' TCP port %s, SSL", l_server, str(l_port))
-                if 'insecure' in l_secure:
-                    ssl_context = ssl._create_unverified_context()
-                    self.connect_imap = imaplib.IMAP4_SSL(host=l_server, port=l_port, ssl_context=ssl_context)
-                else:
-                    self.connect_imap = imaplib.IMAP4_SSL(l_server, l_port)
-            elif 'TLS' in l_secure:
-                logger.info("Connecting to '%s' TCP port %s, SSL", l_server, str(l_port))
-                self.connect_imap = imaplib.IMAP4(l_server, l_port)
-
-                if 'insecure' in l_secure:
-                    tls_context = ssl._create_unverified_context()
-                else:
-                    tls_context = ssl.create_default_context()
-
-                self.connect_imap.starttls(ssl_context=tls_context)
-            else:
-                logger.info("Connecting to '%s' TCP port %d", l_server, str(l_port))
-                self.connect_imap = imaplib.IMAP4(l_server, l_port)
-
-            result_connect = True
-        except socket.gaierror as e:
-            (err, desc) = e
-            logger.error("ERROR: problem looking up server '%s' (%s %s)" , l_server, err, desc)
-        except socket.error as e:
-            logger.error("ERROR: could not connect to '%s' (%s)", l_server, str(e))
-        except Exception as e:
-            logger.error("ERROR: Host %s. %s", l_server, str(e))
-
-        return result_connect
-
-    def loginUser(self, user):
-
-        l_pw = self.master_pwd
-        l_login_user = '{user}*{master}'.format(user=user, master=self.master_login)
-
-        result_login = False
-
-        try:
-            self.connect_imap.login(l_login_user, l_pw)
-            result_login = True
-            logger.info("IMAP connect, success login on [%s] with user [%s]", self.server, user)
-        except socket.gaierror as e:
-            (err, desc) = e
-            logger.error("IMAP connect ERROR: problem looking up server '%s' (%s %s)", self.server, err, desc)
-        except socket.error as e:
-            logger.error("IMAP connect ERROR: could not connect to '%s' (%s)", self.server, e)
-        except Exception as e:
-            logger.error("IMAP connect ERROR: Host %s, user=%s", self.server, user)
-            logger.error(str(e))
-
-        return result_login
-
-    def logOut(self):
-        self.connect_imap.logout()
-
-    def listMailboxes(self):
-        (res, data) = self.connect_imap.list()
-        list_folder = []
-        if res != 'OK':
-            logger.error('IMAP Error list folder %s - %s', res, str(data))
-            return list_folder
-
-        list_re = re.compile(r'\((?P<flags>.*)\)\s+"(?P<delimiter>.*)"\s+"?(?P<name>[^"]*)"?')
-        for f in data:
-            m = list_re.match(f.decode('UTF-8'))
-            if not m:
-                logger.error('IMAP Error decode folder name, size, flags: %s', f.decode('UTF-8'))
-                return None
-
-            flags, delimiter, mailbox = m.groups()
-            # print('server:', self.server, 'folder:', f.decode('UTF-8'), 'mailbox:', mailbox)
-            list_folder.append({
-                'flags': flags,
-                'delimiter': delimiter,
-                'mailbox': mailbox,
-                'noselect': ('Noselect' in flags)
-                # 'messages': mcount,
-                # 'size': msize
-            })
-
-        return list_folder
-
-    def capability(self):
-        typ, data = self.connect_imap.capability()
-        return data[0].decode('utf-8')
-
-    def createMailbox(self, name_mailbox):
-        self.connect_imap.create(name_mailbox)
-
-    def openFolder(self, folder_name, read_only=True):
-        rv, data = self.connect_imap.select(folder_name, read_only)
-        res = rv == 'OK'
-        return res, data
-
-    def closeFolder(self):
-        self.connect_imap.unselect()
-
-    def getListMessagesMailBox(self, param_search={}):
-        cmd_search = self.__getCmdSearchMail(param_search)
-        try:
-            rv, data = self.connect_imap.search(None, cmd_search)
-            if rv != 'OK':
-                logger.error('IMAP error list message mailbox %s, result %s - %s', self.server, rv, str(data))
-                return False, []
-
-            msg_ids = data[0].split()
-            result = True
-        except Exception as e:
-            logger.error('IMAP error list message mailbox %s, %s', self.server, str(e))
-            return False, []
-
-        return result, msg_ids
-
-    def __getCmdSearchMail(self, param_search):
-        maxage = param_search.get('maxage')
-        minage = param_search.get('minage')
-
-        cmd = '(undeleted'
-        if maxage:
-            date = (datetime.date.today() - datetime.timedelta(int(maxage))).strftime("%d-%b-%Y")
-            cmd += ' SENTSINCE {data}'.format(data=date)
-
-        if minage:
-            date = (datetime.date.today() - datetime.timedelta(int(minage))).strftime("%d-%b-%Y")
-            cmd += ' SINCE {data}'.format(data=date)
-        cmd += ')'
-        return cmd
-
-    def getMessageId(self, mail_imap_id):
-        res, data = self.connect_imap.fetch(mail_imap_id, '(BODY.PEEK[HEADER] FLAGS RFC822.SIZE)')
-        if res != 'OK':
-            logger.error('IMAP error get message ID %s, result %s - %s', mail_imap_id, res, str(data))
-            return None, None, None
-
-        # remove flag Recent but This flag can not
-        # be altered by the client
-
-        flag_t = imaplib.ParseFlags(data[0][0])
-        flag = None
-        index_flag = 0
-        for cur_flag in flag_t:
-            str_flag = cur_flag.decode("utf-8")
-            if str_flag.upper() not in IGNORED_FLAGS_MAIL:
-                if index_flag == 0:
-                    if str_flag[0] == '\\':
-                        flag = '{}'.format(str_flag)
-                    else:
-                        flag = r'\\{}'.format(str_flag)
-                else:
-                    flag += ' {f}'.format(f=str_flag.replace(r'\\', ''))
-                index_flag += 1
-
-        size = 0
-        rem = cmp_size_mail.search(str(data[0][0]))
-        if rem:
-            try:
-                size = int(rem.group(1))
-            except:
-                size = 0
-
-        headers = email.message_from_bytes(data[0][1])
-        return headers['Message-ID'], flag, size
-
-    def getMessage(self, mail_imap_id):
-        res, data = self.connect_imap.fetch(mail_imap_id, '(RFC822)')
-        if res != 'OK':
-            logger.error('IMAP error get message %s, result %s - %s', mail_imap_id, res, str(data))
-            return None
-
-        return data[0][1]
-
-    def appendMessage(self, folder, data_message, flags, mail_user=''):
-        typ = 'None'
-        try:
-            typ, dat = self.connect_imap.append(folder, flags, None, data_message)
-        except Exception as e:
-            logger.error('IMAP error append message %s with flags %s, folder %s, ex: %s',
-                         self.server, str(flags), folder, str(e))
-            try:
-                typ, dat = self.connect_imap.append(folder, None, None, data_message)
-            except Exception as e:
-                logger.error('IMAP error append %s message %s without flags %s, folder %s, ex: %s',
-                             self.server, mail_user, str(flags), folder, str(e))
-
-        return typ == 'OK'
-
-    def updateMessage(self, mail_imap_id, flags, mail_user=''):
-        typ = 'None'
-        try:
-            typ, dat = self.connect_imap.uid('store', mail_imap_id, '+FLAGS', flags)
-        except Exception as e:
-            logger.error('IMAP error update flags %s message %s id %s, flags: %s, ex: %s',
-                         self.server, mail_user, mail_imap_id, flags, str(e))
-
-        return typ == 'OK'
-
-
-def secondsToStr(t):
-    return "%d:%02d:%02d.%03d" % \
-           functools.reduce(lambda ll, b: divmod(ll[0], b) + ll[1:],
-                            [(t * 1000,), 1000, 60, 60])
-
-
-def runThreadSyncMail(user, settings_imap):
-    append_messages = 0
-    append_size_byte = 0
-    updated_messages = 0
-    error_updates = 0
-
-    start_time = time.time()
-    logger.info('Thread %s start sync', user)
-
-    src_imap_conn = IMAPServer()
-    dst_imap_conn = IMAPServer()
-    if not src_imap_conn.connect(settings_imap.get('SERVER_IMAP_SOURCE')):
-        return
-
-    if not dst_imap_conn.connect(settings_imap.get('SERVER_IMAP_DESTINATION')):
-        return
-
-    result = src_imap_conn.loginUser(user) and dst_imap_conn.loginUser(user)
-    if result:
-        logger.info('Capability source: %s', src_imap_conn.capability())
-        logger.info('Capability source: %s', dst_imap_conn.capability())
-        src_list_folder = src_imap_conn.listMailboxes()
-        # dst_list_folder = self.dst_imap_conn.listMailboxes()
-        for item_folder in src_list_folder:
-            current_mailbox = item_folder.get('mailbox')
-            # print('Folder: %s, Delimiter: %s, Flags: %s' % (current_mailbox,
-            #                                                item_folder.get('delimiter'),
-            #                                                item_folder.get('flags')))
-
-            if not item_folder.get('noselect'):
-                dst_imap_conn.createMailbox(current_mailbox)
-
-                # Fetch destination messages ID
-                logger.info('Thread %s, fetch messages ID from %s', user, current_mailbox)
-                dst_message_ids = {}
-
-                src_res, src_msg = src_imap_conn.openFolder(current_mailbox, True)
-                dst_res, dst_msg = dst_imap_conn.openFolder(current_mailbox)
-                if not src_res or not dst_res:
-                    if not src_res:
-                        logger.error('Thread %s, error open src folder %s - %s', user, current_mailbox, src_msg)
-                    else:
-                        src_imap_conn.closeFolder()
-                    if not dst_res:
-                        logger.error('Thread %s, error open dst folder %s - %s', user, current_mailbox, dst_msg)
-                    else:
-                        dst_imap_conn.closeFolder()
-                    continue
-
-                result, dst_ids = dst_imap_conn.getListMessagesMailBox(settings_imap.get('filter_email'))
-                if result:
-                    count_all_dst = len(dst_ids)
-                    count_dst = 0
-                    for did in dst_ids:
-                        count_dst += 1
-                        msgid, flg, size_msg = dst_imap_conn.getMessageId(did)
-                        dst_message_ids[msgid] = {'flag': flg, 'id': did, 'size_byte': size_msg}
-                        if logger.isEnabledFor(logging.DEBUG) and (count_dst % 10) == 0:
-                            logger.debug('Thread %s, Message dst parse %s %% (%s in %s)',
-                                         user, str(round(count_dst / count_all_dst * 100)),
-                                         str(count_dst), str(count_all_dst))
-                        # dst_message_ids.append(msgid)
-
-                    src_message_ids = {}
-                    count_src = 0
-                    count_all_crs = 0
-                    result, src_ids = src_imap_conn.getListMessagesMailBox(settings_imap.get('filter_email'))
-                    if result:
-                        count_all_crs = len(src_ids)
-                        for did in src_ids:
-                            count_src += 1
-                            msgid, flg, size_msg = src_imap_conn.getMessageId(did)
-                            if not src_message_ids.get(msgid):
-                                src_message_ids[msgid] = {'flag': flg, 'id': did, 'size_byte': size_msg}
-                            elif size_msg != src_message_ids[msgid].get('size_byte'):
-                                src_message_ids[msgid] = {'flag': flg, 'id': did, 'size_byte': size_msg}
-                            if logger.isEnabledFor(logging.DEBUG) and (count_src % 10) == 0:
-                                logger.debug('Thread %s, Message src parse %s %% (%s in %s)',
-                                             user, str(round(count_src / count_all_crs * 100)),
-                                             str(count_src), str(count_all_crs))
-                            # src_message_ids.append(msgid)
-
-                    # print('Source:', len(src_message_ids), "message IDs acquired.")
-                    logger.info('Thread %s, start sync mail %s, count src:%s dst:%s',
-                                user, current_mailbox, str(count_src), str(count_dst))
-
-                    append_messages_folder = 0
-                    append_size_folder = 0
-                    count_src = 0
-                    count_error_sync = 0
-                    count_error_sync_flags = 0
-                    for src_msg_id in src_message_ids:
-                        count_src += 1
-                        msg_data = src_message_ids.get(src_msg_id)
-                        if src_msg_id not in dst_message_ids:
-                            data_message = src_imap_conn.getMessage(msg_data.get('id'))
-                            res_sync = dst_imap_conn.appendMessage(current_mailbox,
-                                                                   data_message, msg_data.get('flag'), user)
-                            if not res_sync:
-                                count_error_sync += 1
-                                logger.error('Thread %s, error append %s message %s',
-                                             user, current_mailbox, src_msg_id)
-
-                            append_messages_folder += 1
-                            append_size_folder += msg_data.get('size_byte')
-
-                        else:
-                            res_sync = dst_imap_conn.updateMessage(msg_data.get('id'), msg_data.get('flag'), user)
-                            if not res_sync:
-                                count_error_sync_flags += 1
-                                logger.error('Thread %s, error update %s flags message %s',
-                                             user, current_mailbox, src_msg_id)
-
-                        if logger.isEnabledFor(logging.DEBUG) and (count_src % 10) == 0:
-                            logger.debug('Thread %s, message processing %s %% (%s in %s)',
-                                         user, str(round(count_src / count_all_crs * 100)),
-                                         str(count_src), str(count_all_crs))
-
-                    logger.info('Thread %s, Appends to destination count:%s size:%s, count error:%s',
-                                user, str(append_messages_folder), str(append_size_folder),
-                                str(count_error_sync_flags + count_error_sync))
-                    append_messages += append_messages_folder
-                    append_size_byte += append_size_folder
-                    error_updates += count_error_sync_flags + count_error_sync
-
-                dst_imap_conn.closeFolder()
-                src_imap_conn.closeFolder()
-
-        src_imap_conn.logOut()
-        dst_imap_conn.logOut()
-    logger.info('Thread %s, Finish sync append message count:%s size:%s',
-                user, str(append_messages), str(append_size_byte))
-
-    second_execute = secondsToStr(time.time() - start_time)
-    return 'Finish Sync: {uSr}, append messages: {countmsg}, ' \
-           'size: {sZ} byte, error updated: {eUPD} , time executed: {tEx}'.format(uSr=user,
-                                                                                  countmsg=append_messages,
-                                                                                  eUPD=error_updates,
-                                                                                  sZ=append_size_byte,
-                                                                                  tEx=second_execute)
-
-
-class main:
-    NAME = 'Sync iredadmin LDAP backend user'
-    VERSION = '0.1'
-
-    def __init__(self):
-        self.ldap_src = None
-        self.ldap_dst = None
-        self.src_imap_conn = None
-        self.dst_imap_conn = None
-        self.param_filter_email = {}
-
-    def __del__(self):
-        self.ldap_src = None
-        self.ldap_dst = None
-        self.src_imap_conn = None
-        self.dst_imap_conn = None
-
-    def run(self):
-        logger.info('Start sync iRedMail')
-
-        # Instantiate the parser
-        parser = argparse.ArgumentParser(description='Sync user ldap backend iredadmin')
-        subparser = parser.add_subparsers(help='List of commands')
-
-        parser.add_argument('-d', '--domainsync', help='Sync domain [only domain]', nargs='?', const='*', type=str)
-        parser.add_argument('-u', '--usersync', help='Sync user [only user]', nargs='?', const='*', type=str)
-        parser.add_argument('-m', '--mailsync', help='sync mail on imap protocol', action='store_true')
-
-        parser_filter = subparser.add_parser('filter', help='parameters filter email sync')
-        parser_filter.add_argument('age', type=str, choices=['min', 'max'], help='type age email')
-        parser_filter.add_argument('countage', type=int, help='count days age mail (min or max)')
-
-        program_args = parser.parse_args()
-        param_usernsync = program_args.usersync
-        param_domainsync = program_args.domainsync
-        param_mailsync = program_args.mailsync
-        vars_param = vars(program_args)
-        if vars_param.get('age'):
-            if program_args.age == 'min':
-                self.param_filter_email['minage'] = vars_param.get('countage')
-            else:
-                self.param_filter_email['maxage'] = vars_param.get('countage')
-
-        if param_domainsync or param_usernsync:
-            self.ldap_src = LdapServer()
-            res = self.ldap_src.connect(settings.SERVER_SOURCE)
-            if not res[0]:
-                logger.error('Error connect to ldap server source : %s' % res[1])
-
-            self.ldap_dst = LdapServer()
-            res = self.ldap_dst.connect(settings.SERVER_DESTINATION)
-            if not res[0]:
-                logger.error('Error connect to ldap server destination : %s' % res[1])
-
-            if param_domainsync:
-                self.__syncDomain(param_domainsync)
-            else:
-                param_domainsync = '*'
-
-            if param_usernsync:
-                self.__syncUsers(param_domainsync, param_usernsync)
-
-            logger.info(self.ldap_src)
-            logger.info(self.ldap_dst)
-
-        if param_mailsync:
-            if not param_usernsync:
-                param_usernsync = '*'
-            self.__syncIMAPEmail(param_domainsync, param_usernsync)
-
-    def __syncDomain(self, domain_sync):
-        # sync domain
-        if domain_sync == '*':
-            src_domains = self.ldap_src.getDomainList()
-            if len(src_domains) == 0:
-                logger.warning('Source LDAP not contains domain list status in enabled')
-                return
-        else:
-            src_domains = self.ldap_src.getDomain(domain_sync)
-            if len(src_domains) == 0:
-                logger.warning('Source LDAP not contains domain list status in enabled')
-                return
-
-        for src_domain in src_domains:
-            attr = src_domain['attributes']
-            dn = self.ldap_src.getDomainNameFromFullDN(src_domain['dn'])
-            logger.info('Sync domain : %s' % dn)
-            resultCheck = self.ldap_dst.checkDomain(dn, attr)
-            if resultCheck[0] == 'MODIFY':
-                self.ldap_dst.updateDomain(resultCheck[1], resultCheck[2])
-                logger.info('Modify attribute domain %s - %s', str(resultCheck[1]), str(resultCheck[2]))
-            elif resultCheck[0] == 'ADD':
-                self.ldap_dst.addDomain(resultCheck[1], resultCheck[2])
-                logger.info('Create domain %s - %s', str(resultCheck[1]), str(resultCheck[2]))
-
-    def __syncUsers(self, domain, user):
-        user_list = self.ldap_src.getUserList(domain)
-        for src_user in user_list:
-            dn_mail, usr_mail = self.ldap_src.getUserMailNameFromFullDN(src_user['dn'])
-            src_attr = src_user['attributes']
-
-            if user and user != '*' and usr_mail != user:
-                continue
-
-            logger.info('Sync user: %s', usr_mail)
-            resultCheck = self.ldap_dst.checkUser(usr_mail, src_attr)
-            if resultCheck[0] == 'MODIFY':
-                logger.info('Modify user : %s - %s', str(resultCheck[1]), str(resultCheck[2]))
-                self.ldap_dst.updateUser(resultCheck[1], resultCheck[2])
-            elif resultCheck[0] == 'ADD':
-                logger.info('Create user : %s - %s', str(resultCheck[1]), str(resultCheck[2]))
-                self.ldap_dst.addUser(resultCheck[1], resultCheck[2]
-                                      , settings.SERVER_DESTINATION)
-
-    def __syncIMAPEmail(self, domain, user):
-        # The specified user has advantage over the domain
-        logger.info('===================Start sync mail============================')
-
-        if not user or user == '*':
-            user_list = []
-            raw_user_list = self.ldap_src.getUserList(domain)
-            for item_user_list in raw_user_list:
-                dn_mail, usr_mail = self.ldap_src.getUserMailNameFromFullDN(item_user_list['dn'])
-                user_list.append(usr_mail)
-        else:
-            user_list = [user]
-
-        setting_thread = {
-            'SERVER_IMAP_SOURCE': settings.SERVER_IMAP_SOURCE,
-            'SERVER_IMAP_DESTINATION': settings.SERVER_IMAP_DESTINATION,
-            'filter_email': self.param_filter_email
-        }
-
-        r_sync = {}
-        with concurrent.futures.ThreadPoolExecutor(max_workers=settings.max_thread_sync_mail) as executor:
-
-            threadSync = {executor.submit(runThreadSyncMail, user=item_user, settings_imap=setting_thread): item_user
-                          for item_user in user_list}
-
-            for future in concurrent.futures.as_completed(threadSync):
-                user_sync = threadSync[future]
-                try:
-                    result_sync = future.result()
-                except Exception as exc:
-                    logger.error('%s generated an exception: %s', user_sync, str(exc))
-                    r_sync[user_sync] = {'result': False, 'msg': str(exc)}
-                else:
-                    logger.info('%s sync: %s', user_sync, result_sync)
-                    r_sync[user_sync] = {'result': True, 'msg': result_sync}
-
-        logger.info('===================Finish all sync============================')
-        for item_user in user_list:
-            result_sync_user = r_sync.get(item_user)
-            if result_sync_user:
-                logger.info('%s [%s]:%s', item_user, result_sync_user.get('result'), result_sync_user.get('msg'))
-            else:
-                logger.info('%s [ERROR]: NOT', item_user)
-
-
-if __name__ == '__main__':
-    app = main()
-    app.run()
-    sys.exit(0)
+#!/usr/bin/env python3
+# Author: Alexandr Maievsky <softstar2004@gmail.com>
+# Purpose: Synchronization domains and mails of two iredadmin servers with LDAP backend.
+#
+# Usage:
+#   write setting access to ldap server to setting.py, example setting.py.exampl
+#   python MigrateUserLDAP.py
+# ------------------------------------------------------------------
+
+import warnings
+from cryptography.utils import CryptographyDeprecationWarning
+with warnings.catch_warnings():
+    warnings.filterwarnings('ignore', category=CryptographyDeprecationWarning)
+
+import argparse
+import asyncio
+import atexit
+import collections
+import imaplib
+import re
+import socket
+import sys
+import zlib
+import threading
+import time
+import ssl
+import ldap3
+from ldap3 import Server, Connection, ALL
+import datetime
+import settings
+import concurrent.futures
+import functools
+from cache import MessageIdCache, MsgTable, hashMessageId
+import logging
+import logging.handlers
+import queue
+import asyncssh
+
+# aioimaplib is optional: if present the mail sync runs over asyncio with
+# pipelined IMAP commands, otherwise the classic imaplib thread path is used.
+try:
+    import aioimaplib
+except ImportError:
+    aioimaplib = None
+
+# Default groups which will be created while create a new domain.
+# WARNING: Don't use unicode string here.
+DEFAULT_GROUPS = ('Users', 'Groups', 'Aliases', 'Externals')
+LDAP_SEARCH_ALL_DOMAINS = '(&(objectClass=mailDomain)(!(accountStatus=disabled))(enabledService=mail))'
+LDAP_SEARCH_DOMAIN = '(&(objectClass=mailDomain)(!(accountStatus=disabled))(enabledService=mail)(domainName={dN}))'
+LDAP_SEARCH_ALL_USERS = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail))'
+LDAP_SEARCH_USERS_DOMAIN = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail)(mail=*@{dM}))'
+LDAP_SEARCH_ALL_GROUP_DOMAIN = '(&(objectClass=organizationalUnit))'
+LDAP_SEARCH_USER = '(&(objectClass=mailUser)(!(domainStatus=disabled))(enabledService=mail)(mail={uMail}))'
+DOMAIN_ATTRS_ALL = (
+    # Normal attributes.
+    'domainName', 'domainPendingAliasName', 'domainAliasName',
+    'cn', 'description', 'accountStatus', 'domainBackupMX',
+    'domainAdmin', 'mtaTransport', 'enabledService',
+    'domainRecipientBccAddress', 'domainSenderBccAddress',
+    'senderRelayHost', 'disclaimer',
+    'domainCurrentQuotaSize',
+    # 'domainCurrentUserNumber',
+    # 'domainCurrentListNumber',
+    # 'domainCurrentAliasNumber',
+    'accountSetting',
+)
+USER_ATTRS_SYNC = (
+    'mail', 'cn', 'sn', 'uid', 'accountStatus', 'mailQuota',
+    'employeeNumber', 'title', 'senderRelayHost',
+    'shadowAddress', 'mailForwardingAddress', 'memberOfGroup',
+    'enabledService', 'disabledService',
+    'domainGlobalAdmin',  # Global admin
+    'shadowLastChange',  # Password last change, it's number of days since
+    'givenName',
+    'mobile', 'telephoneNumber', 'preferredLanguage', 'memberOfGroup',
+    'userRecipientBccAddress', 'userSenderBccAddress',
+    'mtaTransport',
+    'accountSetting',
+    'allowNets',
+    'street',
+    'postalCode',
+    'postalAddress',
+)
+USER_ATTRS_ALL = tuple(list(USER_ATTRS_SYNC) + [
+    'storageBaseDirectory', 'mailMessageStore', 'homeDirectory'
+])
+# lower-cased frozensets for O(1) membership tests on the diff hot path
+DOMAIN_ATTRS_ALL_SET = frozenset(a.lower() for a in DOMAIN_ATTRS_ALL)
+USER_ATTRS_SYNC_SET = frozenset(a.lower() for a in USER_ATTRS_SYNC)
+
+
+def _hashable(v):
+    # LDAP values are usually str/bytes/int; fall back to repr for the rest
+    return v if isinstance(v, (str, int, bytes)) else repr(v)
+
+
+def _flatten_attrs(raw):
+    # ldap3 returns attributes in a CaseInsensitiveDict whose lookups do a
+    # case-folding scan; rekey once so every later lookup is a plain dict hit.
+    # LDAP attribute names are case-insensitive, so lower-cased keys stay
+    # valid in add/modify requests built from the diff.
+    return {k.lower(): v for k, v in raw.items()}
+
+
+# DN builders are on the per-user hot path; memoize instead of re-formatting
+# the same domain/user DN strings on every call.
+@functools.lru_cache(maxsize=4096)
+def _domain_dn(domain, basedn):
+    return f'domainName={domain},{basedn}'
+
+
+@functools.lru_cache(maxsize=4096)
+def _ou_dn(ou, domain, basedn):
+    return f'ou={ou},domainName={domain},{basedn}'
+
+
+@functools.lru_cache(maxsize=8192)
+def _user_dn(mail, domain, basedn):
+    return f'mail={mail},ou=Users,domainName={domain},{basedn}'
+
+def _tuneSocket(sock):
+    """Disable Nagle and enable keepalive on a connected TCP socket.
+
+    IMAP metadata commands and LDAP pages are small writes; with Nagle on,
+    each can stall up to ~40ms waiting to piggyback on an ACK. Larger
+    socket buffers keep big APPEND literals from being kernel-copy bound.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+
+        buf_size = int(getattr(settings, 'socket_buffer_size', 1 << 20))
+        if buf_size > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buf_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buf_size)
+    except OSError as e:
+        logger.warning('Socket tuning failed: %s', str(e))
+
+
+class _CompressedSocket:
+    """zlib filter pair between imaplib and its socket (COMPRESS=DEFLATE).
+
+    imaplib writes through sock.sendall and reads through the buffered file
+    from makefile(); after the COMPRESS handshake both are routed here.
+    Every write ends with Z_SYNC_FLUSH so the server can parse the command
+    without waiting for more compressed input.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._in = zlib.decompressobj(-15)
+        self._out = zlib.compressobj(6, zlib.DEFLATED, -15)
+
+    def sendall(self, data):
+        self._sock.sendall(self._out.compress(data)
+                           + self._out.flush(zlib.Z_SYNC_FLUSH))
+
+    def recv(self, size=65536):
+        while True:
+            raw = self._sock.recv(size)
+            if not raw:
+                return b''
+            out = self._in.decompress(raw)
+            if out:
+                return out
+
+    def makefile(self, mode='rb'):
+        return _CompressedReader(self)
+
+    def close(self):
+        self._sock.close()
+
+    # imaplib calls these on the socket directly; pass them through
+    def shutdown(self, how):
+        self._sock.shutdown(how)
+
+    def setsockopt(self, *args):
+        self._sock.setsockopt(*args)
+
+
+class _CompressedReader:
+    """Buffered read side of _CompressedSocket, the imaplib file stand-in."""
+
+    def __init__(self, csock):
+        self._csock = csock
+        self._buf = bytearray()
+
+    def read(self, size):
+        while len(self._buf) < size:
+            chunk = self._csock.recv()
+            if not chunk:
+                break
+            self._buf += chunk
+
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def readline(self, size=-1):
+        # imaplib passes a size cap (_MAXLINE + 1); stop at it like
+        # BufferedReader.readline does
+        while b'\n' not in self._buf and (size < 0 or len(self._buf) < size):
+            chunk = self._csock.recv()
+            if not chunk:
+                break
+            self._buf += chunk
+
+        end = self._buf.find(b'\n') + 1
+        if end == 0:
+            end = len(self._buf)
+        if 0 <= size < end:
+            end = size
+        data = bytes(self._buf[:end])
+        del self._buf[:end]
+        return data
+
+    def close(self):
+        pass
+
+
+# Separator chars skipped when picking maildir hash path characters.
+_STRIP_MAILDIR = str.maketrans('', '', '._-')
+
+
+def _maildir_chars(username):
+    # first three path chars of the hashed maildir layout; separators are
+    # stripped in one C-level pass instead of a per-char Python loop
+    cleaned = username.translate(_STRIP_MAILDIR) or username
+    str1 = cleaned[0]
+    str2 = cleaned[1] if len(cleaned) > 1 else str1
+    str3 = cleaned[2] if len(cleaned) > 2 else str2
+    return str1, str2, str3
+
+
+# Email address.
+RE_EMAIL_TEST = r"""[\w\-\#][\w\-\.\+\=\/\&\#]*@[\w\-][\w\-\.]*\.[a-zA-Z0-9\-]{2,15}"""
+cmp_email = re.compile(r"^" + RE_EMAIL_TEST + r"$", re.IGNORECASE | re.DOTALL)
+# bytes pattern: FETCH meta lines stay undecoded on the hot path
+cmp_size_mail = re.compile(rb'RFC822\.SIZE\s(\d+)')
+# IMAP LIST response line: (flags) "delimiter" "mailbox"
+PATERN_LIST_MAILBOX = r'\((?P<flags>.*)\)\s+"(?P<delimiter>.*)"\s+"?(?P<name>[^"]*)"?'
+cmp_list_mailbox = re.compile(PATERN_LIST_MAILBOX)
+
+# Flags travel through the maps and the cache as a uint8 bitmask; the wire
+# string is rebuilt only in the STORE/APPEND commands. \Recent gets no bit:
+# the client may not set it, which is also why the old code ignored it.
+FLAG_BITS = {
+    b'\\SEEN': 1,
+    b'\\ANSWERED': 2,
+    b'\\FLAGGED': 4,
+    b'\\DELETED': 8,
+    b'\\DRAFT': 16,
+}
+FLAG_NAMES = ((1, '\\Seen'), (2, '\\Answered'), (4, '\\Flagged'),
+              (8, '\\Deleted'), (16, '\\Draft'))
+
+
+def decodeFlags(mask):
+    """Wire form of a flag bitmask, e.g. 5 -> '\\Seen \\Flagged'."""
+    if not mask:
+        return ''
+
+    return ' '.join(name for bit, name in FLAG_NAMES if mask & bit)
+
+# Parts fetched to identify a message without downloading the body.
+FETCH_MESSAGE_META = '(BODY.PEEK[HEADER] FLAGS RFC822.SIZE)'
+# Bulk variant: only the Message-ID header field instead of the full block.
+FETCH_MESSAGE_META_BULK = '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+cmp_fetch_uid = re.compile(rb'UID (\d+)')
+cmp_fetch_literal = re.compile(rb'\{(\d+)\}\r?\n?$')
+cmp_msgid = re.compile(rb'Message-ID:\s*<([^>]+)>', re.IGNORECASE)
+cmp_status_item = re.compile(rb'(\w+) (\d+)')
+# chunk size of streamed message bodies (src FETCH literal -> dst APPEND)
+STREAM_CHUNK_SIZE = 64 * 1024
+# UIDs per bulk STORE command, keeps the command line a sane length
+STORE_CHUNK_MAX_UIDS = 1000
+
+
+def parseMessageMeta(meta_line, header_bytes):
+    """Parse one FETCH response: returns (Message-ID, flag bitmask, size)."""
+    flag = 0
+    for cur_flag in imaplib.ParseFlags(meta_line):
+        # flags outside FLAG_BITS (keywords, session flags) are dropped
+        flag |= FLAG_BITS.get(cur_flag.upper(), 0)
+
+    # search the raw bytes: str() on bytes would allocate an escaped copy
+    size = 0
+    rem = cmp_size_mail.search(meta_line)
+    if rem:
+        try:
+            size = int(rem.group(1))
+        except ValueError:
+            size = 0
+
+    # one precompiled search instead of running the whole email parser
+    # over the header block per message
+    m = cmp_msgid.search(header_bytes)
+    msgid = m.group(1).decode('utf-8', 'surrogateescape') if m else None
+    return msgid, flag, size
+
+
+def getCmdSearchMail(param_search):
+    maxage = param_search.get('maxage')
+    minage = param_search.get('minage')
+
+    # default sync window: without an explicit maxage filter, cap the scan
+    # at max_sync_days so huge old folders are not re-walked every run
+    if not maxage:
+        max_sync_days = getattr(settings, 'max_sync_days', 0)
+        if max_sync_days and int(max_sync_days) > 0:
+            maxage = int(max_sync_days)
+
+    parts = ['(UNDELETED']
+    if maxage:
+        date = (datetime.date.today() - datetime.timedelta(int(maxage))).strftime("%d-%b-%Y")
+        parts.append(' SENTSINCE {data}'.format(data=date))
+
+    if minage:
+        date = (datetime.date.today() - datetime.timedelta(int(minage))).strftime("%d-%b-%Y")
+        if maxage:
+            # both bounds set: a closed SENTSINCE/SENTBEFORE window lets the
+            # server short-circuit on its date index
+            parts.append(' SENTBEFORE {data}'.format(data=date))
+        else:
+            parts.append(' SINCE {data}'.format(data=date))
+    parts.append(')')
+    return ''.join(parts)
+
+# logger
+# logging.basicConfig(filename='sync-iredadmin.log', encoding='utf-8', level=logging.INFO)
+FORMATTER_LOG = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+logger = logging.getLogger('sync')
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(FORMATTER_LOG)
+
+fh = logging.FileHandler(filename='sync-iredadmin.log', encoding='utf-8')
+fh.setLevel(logging.INFO)
+fh.setFormatter(FORMATTER_LOG)
+
+# route records through a queue so async tasks and worker threads never
+# block on the FileHandler lock; a listener thread does the real writes
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, ch, fh, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+class ProviderSSH:
+    """Shared SSH tunnel provider.
+
+    One authenticated asyncssh connection is kept per (server, port, username)
+    and every tunnel request multiplexes a new forwarded channel over it, so
+    a mass sync does not open a fresh SSH handshake per LDAP/IMAP connection
+    (OpenSSH MaxStartups throttles that). The asyncssh event loop runs in a
+    dedicated daemon thread; pooled connections are closed once at exit.
+    """
+
+    _conns = {}
+    _loop = None
+    _loop_thread = None
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.listener = None
+        self.listen_port = None
+        self.is_connected = False
+
+    @classmethod
+    def _getLoop(cls):
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                cls._loop_thread = threading.Thread(target=cls._loop.run_forever,
+                                                    name='ssh-tunnel', daemon=True)
+                cls._loop_thread.start()
+                atexit.register(cls._closeAll)
+
+        return cls._loop
+
+    @classmethod
+    def _runLoop(cls, coro):
+        return asyncio.run_coroutine_threadsafe(coro, cls._getLoop()).result()
+
+    @classmethod
+    def _getConnection(cls, server, port, username, pwd, priv_key):
+        key = (server, port, username)
+        with cls._lock:
+            conn = cls._conns.get(key)
+
+        if conn:
+            return conn
+
+        if pwd:
+            conn = cls._runLoop(asyncssh.connect(server, port=port, username=username,
+                                                 password=pwd, keepalive_interval=30))
+        else:
+            conn = cls._runLoop(asyncssh.connect(server, port=port, username=username,
+                                                 client_keys=[priv_key], keepalive_interval=30))
+
+        with cls._lock:
+            # another thread may have finished its handshake for the same
+            # key meanwhile; keep the pooled one and close the duplicate
+            winner = cls._conns.setdefault(key, conn)
+
+        if winner is not conn:
+            cls._getLoop().call_soon_threadsafe(conn.close)
+
+        return winner
+
+    @classmethod
+    def _dropConnection(cls, conn):
+        """Evict a pooled connection whose tunnel died.
+
+        Without the eviction every later connect() for the key keeps
+        reusing the dead connection until the process restarts.
+        """
+        with cls._lock:
+            for key, pooled in list(cls._conns.items()):
+                if pooled is conn:
+                    del cls._conns[key]
+                    break
+
+        cls._getLoop().call_soon_threadsafe(conn.close)
+
+    @classmethod
+    def _closeAll(cls):
+        with cls._lock:
+            conns = list(cls._conns.values())
+            cls._conns.clear()
+            loop = cls._loop
+            cls._loop = None
+
+        if loop:
+            for conn in conns:
+                loop.call_soon_threadsafe(conn.close)
+            loop.call_soon_threadsafe(loop.stop)
+
+    def connect(self, setting_connect):
+        param_connect = setting_connect.get('over_ssh')
+        server = param_connect.get('server')
+        port = param_connect.get('port')
+        username = param_connect.get('username')
+        pwd = param_connect.get('pwd')
+        privKey = param_connect.get('privkey')
+
+        self.is_connected = False
+        try:
+            connect_ssh = self._getConnection(server, port, username, pwd, privKey)
+
+            server_dst = setting_connect.get('server')
+            port_dst = setting_connect.get('port')
+            try:
+                self.listener = self._runLoop(
+                    connect_ssh.forward_local_port('', 0, server_dst, port_dst))
+            except Exception:
+                # a dead tunnel cannot forward; evict it so the next
+                # connect() builds a fresh one
+                self._dropConnection(connect_ssh)
+                raise
+            self.listen_port = self.listener.get_port()
+            logger.info('SSH Listening %s on port %s', server_dst, str(self.listen_port))
+            self.is_connected = True
+
+        except socket.gaierror as e:
+            (err, desc) = e
+            logger.error("SSH ERROR: problem looking up server '%s' (%s %s)", server, err, desc)
+        except socket.error as e:
+            logger.error("SSH ERROR: could not connect to '%s' (%s)", server, str(e))
+        except Exception as e:
+            logger.error("SSH ERROR: Host %s. %s", server, str(e))
+
+        return self.is_connected
+
+    def getPort(self):
+        return self.listen_port
+
+
+class LdapServer:
+
+    def __init__(self):
+        self.con = None
+        self.srvdn = ''
+        self.srvport = ''
+        self.use_ssl = False
+        self.baseDN = ''
+        self.bind_dn = ''
+        self.bind_password = ''
+        self.ssh_server = ''
+        self.ssh_port = None
+        self.ssh_username = ''
+        self.ssh_password = ''
+        self.privatekey = ''
+        self.provider_ssh = None
+
+    def __del__(self):
+        self.__disconnect()
+
+    def __str__(self):
+        if self.con:
+            return str(self.con)
+
+        return 'None connect'
+
+    def __disconnect(self):
+        if self.con:
+            self.con.unbind()
+            self.con = None
+
+    def connect(self, setting_connect):
+        if not setting_connect:
+            logger.error('LDAP Error setting server connected')
+            return False, 'LDAP Error setting server connected'
+
+        over_ssh = setting_connect.get('over_ssh')
+        if over_ssh:
+            self.provider_ssh = ProviderSSH()
+            result_over_ssh = self.provider_ssh.connect(setting_connect)
+            if not result_over_ssh:
+                logger.warning('LDAP Warn error connected server SHH')
+                return False, 'Error connected server SSH'
+
+        self.srvdn = setting_connect.get('server')
+        if over_ssh:
+            self.srvport = self.provider_ssh.getPort()
+        else:
+            self.srvport = setting_connect.get('port')
+
+        self.baseDN = setting_connect.get('basedn')
+        self.bind_dn = setting_connect.get('bind_dn')
+        self.bind_password = setting_connect.get('bind_password')
+        self.use_ssl = setting_connect.get('use_ssl', False)
+        if not self.baseDN:
+            self.baseDN = self.__getBaseDNFromUser(self.bind_dn)
+
+        s = Server(self.srvdn, self.srvport, use_ssl=self.use_ssl, get_info=ALL,
+                   connect_timeout=5)
+        # REUSABLE keeps a pool of bound connections, so parallel sync workers
+        # don't serialize on a single socket nor pay a re-bind per operation.
+        self.con = Connection(s, user=self.bind_dn, password=self.bind_password,
+                              authentication=ldap3.SIMPLE,
+                              client_strategy=ldap3.REUSABLE,
+                              pool_name='sync',
+                              pool_size=getattr(settings, 'LDAP_POOL_SIZE', 5),
+                              pool_lifetime=600,
+                              pool_keepalive=60)
+
+        if not self.con.bind():
+            return False, self.con.result
+
+        # the REUSABLE pool has no single socket; tune it when exposed
+        sock = getattr(self.con, 'socket', None)
+        if sock:
+            _tuneSocket(sock)
+
+        return True,
+
+    def __getResponse(self, msg_id):
+        # operations on a REUSABLE pool return a message id; resolve it here
+        response, result = self.con.get_response(msg_id)
+        return response, result
+
+    @staticmethod
+    def __parceServerLDAP(param_server: str):
+        p = param_server.split(':')
+        if len(p) != 3:
+            logger.error('Error parameter server \'ldap[s]://[ip]:port\': {}'.format(param_server))
+            return None
+
+        use_ssl = False
+        if p[0] == 'ldaps':
+            use_ssl = True
+
+        srv = p[1].replace('//', '')
+        port = int(p[2])
+        return dict(server=srv, port=port, use_ssl=use_ssl)
+
+    @staticmethod
+    def __getBaseDNFromUser(user_name: str):
+        bDN = ''
+        p = user_name.split(',')
+        for dc in p:
+            if dc.find('dc=') != -1:
+                bDN += ',' + dc
+
+        return 'o=domains{dn}'.format(dn=bDN)
+
+    # region Domain
+    def getDomainList(self):
+        # generator=True streams entries page by page instead of buffering
+        # the whole result set in RAM before the caller sees the first entry
+        searchDN = self.baseDN
+        yield from self.con.extend.standard.paged_search(search_base=searchDN,
+                                                         search_filter=LDAP_SEARCH_ALL_DOMAINS,
+                                                         search_scope=ldap3.SUBTREE,
+                                                         attributes=DOMAIN_ATTRS_ALL,
+                                                         paged_size=getattr(settings, 'LDAP_PAGE_SIZE', 1000),
+                                                         generator=True)
+
+    def getDomain(self, domain):
+        dn = self.baseDN
+        search_filter = LDAP_SEARCH_DOMAIN.format(dN=domain)
+        msg_id = self.con.search(search_base=dn,
+                                 search_filter=search_filter,
+                                 search_scope=ldap3.LEVEL,
+                                 attributes=DOMAIN_ATTRS_ALL,
+                                 paged_size=5)
+        response, result = self.__getResponse(msg_id)
+        if result['description'] != 'success':
+            return []
+
+        return response
+
+    def addDomain(self, domain, attr):
+        dn = _domain_dn(domain, self.baseDN)
+        msg_id = self.con.add(dn=dn, attributes=attr)
+        response, result = self.__getResponse(msg_id)
+        res = result['description'] == 'success'
+        if res:
+            # adding default group domain
+            for itemgroup in DEFAULT_GROUPS:
+                dng = _ou_dn(itemgroup, domain, self.baseDN)
+                msg_id = self.con.add(dn=dng, object_class='organizationalUnit')
+                self.__getResponse(msg_id)
+
+        return res
+
+    def updateDomain(self, domain, attr):
+        dn = _domain_dn(domain, self.baseDN)
+        msg_id = self.con.modify(dn=dn, changes=attr)
+        response, result = self.__getResponse(msg_id)
+
+        return result['description'] == 'success'
+
+    def checkDomain(self, domain, attr):
+        dn = self.baseDN
+        search_filter = LDAP_SEARCH_DOMAIN.format(dN=domain)
+        msg_id = self.con.search(search_base=dn,
+                                 search_filter=search_filter,
+                                 search_scope=ldap3.LEVEL,
+                                 attributes=DOMAIN_ATTRS_ALL,
+                                 paged_size=5)
+        response, result = self.__getResponse(msg_id)
+        if result['description'] != 'success':
+            return 'ERROR', 'Not search domain name {dN}'.format(dN=domain)
+
+        domains = response
+        if len(domains) == 0:
+            return 'ADD', domain, attr
+
+        dm = domains[0]
+        resDiff = self.__getDiffAttr(_flatten_attrs(attr), _flatten_attrs(dm['attributes']),
+                                     DOMAIN_ATTRS_ALL_SET, False)
+        if resDiff:
+            return 'NONE', domain, None
+
+        return 'MODIFY', domain, resDiff
+
+    # endregion
+
+    def getUserList(self, domain='*'):
+        # narrow the search base to the domain container when it is known,
+        # and stream pages of only the synced attributes; with a known
+        # container LEVEL scope keeps the server from walking the subtree
+        if domain == '*':
+            searchDN = self.baseDN
+            searchUser = LDAP_SEARCH_ALL_USERS
+            searchScope = ldap3.SUBTREE
+        else:
+            searchDN = _ou_dn('Users', domain, self.baseDN)
+            searchUser = LDAP_SEARCH_USERS_DOMAIN.format(dM=domain)
+            searchScope = ldap3.LEVEL
+
+        yield from self.con.extend.standard.paged_search(search_base=searchDN,
+                                                         search_filter=searchUser,
+                                                         search_scope=searchScope,
+                                                         attributes=USER_ATTRS_SYNC,
+                                                         paged_size=getattr(settings, 'LDAP_PAGE_SIZE', 1000),
+                                                         generator=True)
+
+    def getUser(self, user):
+        dn = self.baseDN
+        search_filter = LDAP_SEARCH_USER.format(uMail=user)
+        msg_id = self.con.search(search_base=dn,
+                                 search_filter=search_filter,
+                                 search_scope=ldap3.LEVEL,
+                                 attributes=ldap3.ALL_ATTRIBUTES,
+                                 paged_size=5)
+        response, result = self.__getResponse(msg_id)
+        if result['description'] != 'success':
+            return []
+
+        return response
+
+    def loadUsers(self, domain='*'):
+        """Load users once as {mail.lower(): attributes}.
+
+        The driver diffs against this map instead of issuing a second LDAP
+        search per user for entries it already listed.
+        """
+        users = {}
+        for entry in self.getUserList(domain):
+            dn_mail, usr_mail = self.getUserMailNameFromFullDN(entry['dn'])
+            if usr_mail:
+                users[usr_mail.lower()] = entry['attributes']
+
+        return users
+
+    def checkUser(self, user_mail, attr, cached_entry=None):
+
+        if not self.is_email(user_mail):
+            return 'ERROR', 'Name user not valid'
+
+        if cached_entry is not None:
+            resDiff = self.__getDiffAttr(_flatten_attrs(attr), _flatten_attrs(cached_entry),
+                                         USER_ATTRS_SYNC_SET, False)
+            if not resDiff:
+                return 'NONE', user_mail
+
+            return 'MODIFY', user_mail, resDiff
+
+        segment_mail = user_mail.split('@')
+        domain = segment_mail[1]
+        dn = _ou_dn('Users', domain, self.baseDN)
+        search_filter = LDAP_SEARCH_USER.format(uMail=user_mail)
+        msg_id = self.con.search(search_base=dn,
+                                 search_filter=search_filter,
+                                 search_scope=ldap3.LEVEL,
+                                 attributes=ldap3.ALL_ATTRIBUTES,
+                                 paged_size=5)
+        response, result = self.__getResponse(msg_id)
+        if result['description'] != 'success':
+            return 'ERROR', 'Not search user name {dN}'.format(dN=user_mail)
+
+        users = response
+        if len(users) == 0:
+            return 'ADD', user_mail, attr
+
+        usr = users[0]
+        resDiff = self.__getDiffAttr(_flatten_attrs(attr), _flatten_attrs(usr['attributes']),
+                                     USER_ATTRS_SYNC_SET, False)
+        if not resDiff:
+            return 'NONE', user_mail
+
+        return 'MODIFY', user_mail, resDiff
+
+    def addUser(self, user_mail, attr, setting_account):
+
+        if not self.is_email(user_mail):
+            return 'ERROR', 'Name user not valid'
+
+        segment_mail = user_mail.split('@')
+
+        domain = segment_mail[1]
+        username = segment_mail[0]
+        dn = _user_dn(user_mail, domain, self.baseDN)
+
+        # add attributes directory new server
+        storage_base_directory = setting_account.get('storage_mail_base_directory')
+        if not storage_base_directory:
+            logger.error('IMAP error add user {} Not setting storage base directory'.format(user_mail))
+            return False
+
+        # Get base directory and storage node.
+        std = storage_base_directory.rstrip('/').split('/')
+        dst_mail_message_store = std.pop()
+        dst_storage_base = '/'.join(std)
+
+        # maildir_domain = str(domain).lower()
+        str1, str2, str3 = _maildir_chars(username)
+
+        timestamp_maildir = '-%s' % time.strftime('%Y.%m.%d.%H.%M.%S')
+        maildir_user = "%s/%s/%s/%s%s/" % (str1, str2, str3, username, timestamp_maildir,)
+
+        dst_home_directory = '{}/{}'.format(storage_base_directory, maildir_user)
+        dst_mail_message_store = '{}/{}'.format(dst_mail_message_store, maildir_user)
+        attr['homeDirectory'] = dst_home_directory
+        attr['mailMessageStore'] = dst_mail_message_store
+        attr['storageBaseDirectory'] = dst_storage_base
+
+        msg_id = self.con.add(dn=dn, attributes=attr)
+        response, result = self.__getResponse(msg_id)
+        res = result['description'] == 'success'
+        return res
+
+    def updateUser(self, user_mail, attr):
+        segment_mail = user_mail.split('@')
+
+        domain = segment_mail[1]
+        dn = _user_dn(user_mail, domain, self.baseDN)
+        msg_id = self.con.modify(dn=dn, changes=attr)
+        response, result = self.__getResponse(msg_id)
+        res = result['description'] == 'success'
+        return res
+
+    @staticmethod
+    def __getDiffAttr(src_attr, dst_attr, list_available_attr=None, delete_dst=False):
+        diffAttr = {}
+
+        for attr in src_attr:
+            if list_available_attr and attr not in list_available_attr:
+                continue
+
+            src_val = src_attr.get(attr)
+            if attr not in dst_attr:
+                if isinstance(src_val, list):
+                    diffAttr[attr] = [(ldap3.MODIFY_ADD, src_val)]
+                else:
+                    diffAttr[attr] = [(ldap3.MODIFY_ADD, [src_val])]
+            else:
+                dst_val = dst_attr.get(attr)
+                if isinstance(src_val, list):
+                    dst_list = dst_val if isinstance(dst_val, list) else [dst_val]
+                    if set(map(_hashable, src_val)) != set(map(_hashable, dst_list)):
+                        diffAttr[attr] = [(ldap3.MODIFY_REPLACE, src_val)]
+                elif src_val != dst_val:
+                    diffAttr[attr] = [(ldap3.MODIFY_REPLACE, [src_val])]
+
+        if delete_dst:
+            for attr in dst_attr:
+                if attr not in src_attr:
+                    diffAttr[attr] = [(ldap3.MODIFY_DELETE, [])]
+
+        return diffAttr
+
+    def addGroupDomain(self, domain, group_name, group_object, attr):
+        dn = _ou_dn(group_name, domain, self.baseDN)
+        msg_id = self.con.add(dn=dn, object_class=group_object, attributes=attr)
+        response, result = self.__getResponse(msg_id)
+
+        return result
+
+    def getGroupDomain(self, domain):
+        searchDN = _domain_dn(domain, self.baseDN)
+        group_domain_list = self.con.extend.standard.paged_search(search_base=searchDN,
+                                                                  search_filter=LDAP_SEARCH_ALL_GROUP_DOMAIN,
+                                                                  search_scope=ldap3.LEVEL,
+                                                                  paged_size=100,
+                                                                  generator=False)
+
+        return group_domain_list
+
+    @staticmethod
+    def getDomainNameFromFullDN(full_dn):
+        items_dn = ldap3.utils.dn.parse_dn(full_dn)
+        for descrDn, valDn, spDn in items_dn:
+            if descrDn == 'domainName':
+                return valDn
+
+        return None
+
+    @staticmethod
+    def getUserMailNameFromFullDN(full_user_dn):
+        usr = ''
+        dn = ''
+        items_dn = ldap3.utils.dn.parse_dn(full_user_dn)
+        for descrDn, valDn, spDn in items_dn:
+            if descrDn == 'mail':
+                usr = valDn
+            elif descrDn == 'domainName':
+                dn = valDn
+
+        return dn, usr
+
+    @staticmethod
+    def is_email(s) -> bool:
+        try:
+            s = str(s).strip()
+        except UnicodeEncodeError:
+            return False
+
+        if cmp_email.fullmatch(s):
+            return True
+
+        return False
+
+
+class IMAPServer:
+
+    def __init__(self):
+        self.server = None
+        self.connect_imap = None
+        self.master_login = None
+        self.master_pwd = None
+        self.caps = frozenset()
+        self.use_multiappend = False
+        self.use_literal_plus = False
+
+    def __del__(self):
+        self.disconnect()
+
+    def disconnect(self):
+        if not self.connect_imap:
+            self.server = None
+            self.connect_imap = None
+
+    def connect(self, config):
+        self.disconnect()
+
+        l_timeout = float(config.get('timeout', 30))
+        l_server = config.get('server')
+        self.server = l_server
+        l_port = config.get('port', 143)
+        l_secure = config.get('secure', 'None')
+        self.master_login = config.get('master_usr')
+        self.master_pwd = config.get('master_pwd')
+
+        result_connect = False
+
+        try:
+            # per-connection timeout: socket.setdefaulttimeout mutated
+            # process-global state and affected every concurrent socket
+            if 'SSL' in l_secure:
+                logger.info("Connecting to '%s' TCP port %s, SSL", l_server, str(l_port))
+                if 'insecure' in l_secure:
+                    ssl_context = ssl._create_unverified_context()
+                    self.connect_imap = imaplib.IMAP4_SSL(host=l_server, port=l_port,
+                                                          ssl_context=ssl_context, timeout=l_timeout)
+                else:
+                    self.connect_imap = imaplib.IMAP4_SSL(l_server, l_port, timeout=l_timeout)
+            elif 'TLS' in l_secure:
+                logger.info("Connecting to '%s' TCP port %s, SSL", l_server, str(l_port))
+                self.connect_imap = imaplib.IMAP4(l_server, l_port, timeout=l_timeout)
+
+                if 'insecure' in l_secure:
+                    tls_context = ssl._create_unverified_context()
+                else:
+                    tls_context = ssl.create_default_context()
+
+                self.connect_imap.starttls(ssl_context=tls_context)
+            else:
+                logger.info("Connecting to '%s' TCP port %d", l_server, str(l_port))
+                self.connect_imap = imaplib.IMAP4(l_server, l_port, timeout=l_timeout)
+
+            _tuneSocket(self.connect_imap.sock)
+            self.__updateCaps()
+            result_connect = True
+        except socket.gaierror as e:
+            (err, desc) = e
+            logger.error("ERROR: problem looking up server '%s' (%s %s)" , l_server, err, desc)
+        except socket.error as e:
+            logger.error("ERROR: could not connect to '%s' (%s)", l_server, str(e))
+        except Exception as e:
+            logger.error("ERROR: Host %s. %s", l_server, str(e))
+
+        return result_connect
+
+    def __updateCaps(self):
+        """Parse the capability list once into a frozenset and flags.
+
+        Refreshed after connect and again after login, since servers may
+        advertise more extensions on an authenticated connection. The hot
+        paths then test plain attributes instead of re-scanning the tuple.
+        """
+        self.caps = frozenset(getattr(self.connect_imap, 'capabilities', ()))
+        self.use_multiappend = 'MULTIAPPEND' in self.caps
+        self.use_literal_plus = 'LITERAL+' in self.caps
+
+    def enableCompression(self):
+        """Switch the connection to COMPRESS=DEFLATE (RFC 4978) if offered.
+
+        imaplib has no native support, so after the tagged OK the socket is
+        wrapped in a zlib filter pair and the buffered reader is replaced.
+        Must run before any folder is selected; no-op when the server does
+        not advertise the capability or the setting is off.
+        """
+        conn = self.connect_imap
+        if not getattr(settings, 'enable_imap_compress', False) \
+                or 'COMPRESS=DEFLATE' not in self.caps:
+            return False
+
+        try:
+            typ, dat = conn._simple_command('COMPRESS', 'DEFLATE')
+        except Exception as e:
+            logger.error('IMAP error enable compression %s, ex: %s', self.server, str(e))
+            return False
+
+        if typ != 'OK':
+            logger.error('IMAP compression rejected %s, result %s - %s', self.server, typ, str(dat))
+            return False
+
+        conn.sock = _CompressedSocket(conn.sock)
+        conn.file = conn.sock.makefile('rb')
+        logger.info('IMAP compression enabled on %s', self.server)
+        return True
+
+    def loginUser(self, user):
+
+        l_pw = self.master_pwd
+        l_login_user = '{user}*{master}'.format(user=user, master=self.master_login)
+
+        result_login = False
+
+        try:
+            self.connect_imap.login(l_login_user, l_pw)
+            result_login = True
+            logger.info("IMAP connect, success login on [%s] with user [%s]", self.server, user)
+            self.__updateCaps()
+            self.enableCompression()
+        except socket.gaierror as e:
+            (err, desc) = e
+            logger.error("IMAP connect ERROR: problem looking up server '%s' (%s %s)", self.server, err, desc)
+        except socket.error as e:
+            logger.error("IMAP connect ERROR: could not connect to '%s' (%s)", self.server, e)
+        except Exception as e:
+            logger.error("IMAP connect ERROR: Host %s, user=%s", self.server, user)
+            logger.error(str(e))
+
+        return result_login
+
+    def logOut(self):
+        self.connect_imap.logout()
+
+    def listMailboxes(self):
+        (res, data) = self.connect_imap.list()
+        list_folder = []
+        if res != 'OK':
+            logger.error('IMAP Error list folder %s - %s', res, str(data))
+            return list_folder
+
+        for f in data:
+            m = cmp_list_mailbox.match(f.decode('UTF-8'))
+            if not m:
+                logger.error('IMAP Error decode folder name, size, flags: %s', f.decode('UTF-8'))
+                return None
+
+            flags, delimiter, mailbox = m.groups()
+            # print('server:', self.server, 'folder:', f.decode('UTF-8'), 'mailbox:', mailbox)
+            list_folder.append({
+                'flags': flags,
+                'delimiter': delimiter,
+                'mailbox': mailbox,
+                'noselect': ('Noselect' in flags)
+                # 'messages': mcount,
+                # 'size': msize
+            })
+
+        return list_folder
+
+    def listFolders(self):
+        """Names of the selectable folders, from one LIST command."""
+        list_folder = self.listMailboxes()
+        if not list_folder:
+            return []
+
+        return [f['mailbox'] for f in list_folder if not f['noselect']]
+
+    def status(self, folder):
+        """STATUS of a folder without selecting it, as a name -> int dict.
+
+        Servers without CONDSTORE reject the HIGHESTMODSEQ item, so the
+        command retries without it. Returns None when STATUS fails.
+        """
+        for items in ('(MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)',
+                      '(MESSAGES UIDNEXT UIDVALIDITY)'):
+            typ = 'None'
+            try:
+                typ, dat = self.connect_imap.status(folder, items)
+            except Exception as e:
+                logger.debug('IMAP status %s folder %s, ex: %s',
+                             self.server, folder, str(e))
+
+            if typ == 'OK' and dat and dat[0]:
+                # parse only the (...) item list: digits in the folder name
+                # itself must not be taken for values
+                payload = dat[0][dat[0].rfind(b'('):]
+                return {name.decode('ascii'): int(value)
+                        for name, value in cmp_status_item.findall(payload)}
+
+        return None
+
+    def capability(self):
+        typ, data = self.connect_imap.capability()
+        return data[0].decode('utf-8')
+
+    def createMailbox(self, name_mailbox):
+        self.connect_imap.create(name_mailbox)
+
+    def openFolder(self, folder_name, read_only=True):
+        rv, data = self.connect_imap.select(folder_name, read_only)
+        res = rv == 'OK'
+        return res, data
+
+    def getFolderUidState(self):
+        """UIDVALIDITY/UIDNEXT of the selected folder, or (None, None)."""
+        try:
+            uidvalidity = int(self.connect_imap.response('UIDVALIDITY')[1][0])
+            uidnext = int(self.connect_imap.response('UIDNEXT')[1][0])
+        except (TypeError, ValueError, IndexError):
+            return None, None
+
+        return uidvalidity, uidnext
+
+    def closeFolder(self):
+        self.connect_imap.unselect()
+
+    def getListMessagesMailBox(self, param_search={}):
+        # UID SEARCH returns stable UIDs directly, so later FETCH/STORE need
+        # no sequence-number remapping; CHARSET UTF-8 skips server-side
+        # charset conversion
+        cmd_search = getCmdSearchMail(param_search)
+        try:
+            rv, data = self.connect_imap.uid('SEARCH', 'CHARSET', 'UTF-8', cmd_search)
+            if rv != 'OK':
+                logger.error('IMAP error list message mailbox %s, result %s - %s', self.server, rv, str(data))
+                return False, []
+
+            msg_ids = data[0].split()
+            result = True
+        except Exception as e:
+            logger.error('IMAP error list message mailbox %s, %s', self.server, str(e))
+            return False, []
+
+        return result, msg_ids
+
+    def getMessageId(self, mail_imap_id):
+        res, data = self.connect_imap.uid('FETCH', self.__asUid(mail_imap_id), FETCH_MESSAGE_META)
+        if res != 'OK':
+            logger.error('IMAP error get message ID %s, result %s - %s', mail_imap_id, res, str(data))
+            return None, None, None
+
+        # remove flag Recent but This flag can not
+        # be altered by the client
+        return parseMessageMeta(data[0][0], data[0][1])
+
+    def fetchHeadersBatch(self, msg_ids, batch=500):
+        """Fetch metadata of many messages with one FETCH per batch of ids.
+
+        Returns a MsgTable keyed by Message-ID hash like the old
+        per-message getMessageId loop, but in ~len(msg_ids)/batch
+        round-trips instead of one per message.
+        """
+        message_ids = MsgTable()
+        for index in range(0, len(msg_ids), batch):
+            ids = ','.join(self.__asUid(m) for m in msg_ids[index:index + batch])
+            if not ids:
+                continue
+
+            try:
+                res, data = self.connect_imap.uid('FETCH', ids, FETCH_MESSAGE_META)
+            except Exception as e:
+                logger.error('IMAP error batch fetch %s, %s', self.server, str(e))
+                continue
+
+            if res != 'OK':
+                logger.error('IMAP error batch fetch %s, result %s - %s', self.server, res, str(data))
+                continue
+
+            self.__parseFetchMeta(data, message_ids)
+
+        return message_ids
+
+    @staticmethod
+    def __parseFetchMeta(data, message_ids):
+        # every message contributes a (meta_line, header_bytes) tuple,
+        # interleaved with closing b')' lines per RFC 3501
+        for part in data:
+            if not isinstance(part, tuple) or len(part) < 2:
+                continue
+
+            msgid, flg, size_msg = parseMessageMeta(part[0], part[1])
+            m_uid = cmp_fetch_uid.search(part[0])
+            if not m_uid:
+                continue
+
+            uid = m_uid.group(1)
+            message_ids.add(hashMessageId(msgid), flg, uid, size_msg, msgid)
+
+        return message_ids
+
+    def fetchMetadataBulk(self, param_search=None, batch=None):
+        """Build the MsgTable of the selected folder in bulk.
+
+        A UID SEARCH picks the candidates first — (UNDELETED) plus the
+        configured date window, see getCmdSearchMail — and its result is
+        chunked into comma sets of fetch_batch_size ids per UID FETCH.
+        Only the Message-ID header field is requested, not the full
+        header block.
+        """
+        if batch is None:
+            batch = getattr(settings, 'fetch_batch_size', 100)
+
+        result, msg_ids = self.getListMessagesMailBox(param_search or {})
+        if not result:
+            return MsgTable()
+
+        uid_sets = [','.join(self.__asUid(m) for m in msg_ids[i:i + batch])
+                    for i in range(0, len(msg_ids), batch)]
+
+        message_ids = MsgTable()
+        for uid_set in uid_sets:
+            if not uid_set:
+                continue
+
+            try:
+                res, data = self.connect_imap.uid('FETCH', uid_set, FETCH_MESSAGE_META_BULK)
+            except Exception as e:
+                logger.error('IMAP error bulk fetch %s, %s', self.server, str(e))
+                continue
+
+            if res != 'OK':
+                logger.error('IMAP error bulk fetch %s, result %s - %s', self.server, res, str(data))
+                continue
+
+            self.__parseFetchMeta(data, message_ids)
+
+        return message_ids
+
+    @staticmethod
+    def __asUid(mail_imap_id):
+        return mail_imap_id.decode() if isinstance(mail_imap_id, bytes) else str(mail_imap_id)
+
+    def getMessage(self, mail_imap_id):
+        res, data = self.connect_imap.uid('FETCH', self.__asUid(mail_imap_id), '(RFC822)')
+        if res != 'OK':
+            logger.error('IMAP error get message %s, result %s - %s', mail_imap_id, res, str(data))
+            return None
+
+        return data[0][1]
+
+    def appendMessage(self, folder, data_message, flags, mail_user=''):
+        typ = 'None'
+        try:
+            typ, dat = self.connect_imap.append(folder, decodeFlags(flags) or None,
+                                                None, data_message)
+        except Exception as e:
+            logger.error('IMAP error append message %s with flags %s, folder %s, ex: %s',
+                         self.server, str(flags), folder, str(e))
+            try:
+                typ, dat = self.connect_imap.append(folder, None, None, data_message)
+            except Exception as e:
+                logger.error('IMAP error append %s message %s without flags %s, folder %s, ex: %s',
+                             self.server, mail_user, str(flags), folder, str(e))
+
+        return typ == 'OK'
+
+    def updateMessage(self, mail_imap_id, flags, mail_user=''):
+        typ = 'None'
+        try:
+            typ, dat = self.connect_imap.uid('STORE', self.__asUid(mail_imap_id), '+FLAGS',
+                                             '({f})'.format(f=decodeFlags(flags)))
+        except Exception as e:
+            logger.error('IMAP error update flags %s message %s id %s, flags: %s, ex: %s',
+                         self.server, mail_user, mail_imap_id, flags, str(e))
+
+        return typ == 'OK'
+
+    def updateMessagesBulk(self, msg_ids, flags, mail_user=''):
+        """Set the same flags on many messages with one UID STORE per chunk.
+
+        msg_ids are chunked into comma sets of STORE_CHUNK_MAX_UIDS uids;
+        flags is a bitmask decoded to its wire form once per chunk.
+        Returns the count of messages in chunks the server rejected.
+        """
+        count_error = 0
+        flag_part = '({f})'.format(f=decodeFlags(flags))
+        for i in range(0, len(msg_ids), STORE_CHUNK_MAX_UIDS):
+            chunk = msg_ids[i:i + STORE_CHUNK_MAX_UIDS]
+            uid_set = ','.join(self.__asUid(m) for m in chunk)
+            typ = 'None'
+            try:
+                typ, dat = self.connect_imap.uid('STORE', uid_set, '+FLAGS', flag_part)
+            except Exception as e:
+                logger.error('IMAP error bulk update flags %s user %s, flags: %s, ex: %s',
+                             self.server, mail_user, flags, str(e))
+
+            if typ != 'OK':
+                count_error += len(chunk)
+
+        return count_error
+
+    def moveMessagesBulk(self, msg_ids, target_folder, mail_user=''):
+        """Move many messages to target_folder with one command per chunk.
+
+        With the MOVE extension (RFC 6851) a chunk costs a single atomic,
+        metadata-only UID MOVE. Servers without it get the classic
+        COPY + STORE \\Deleted + EXPUNGE sequence, chunked the same way.
+        Returns the count of messages in chunks the server rejected.
+        """
+        count_error = 0
+        use_move = self.supportsMove()
+        for i in range(0, len(msg_ids), STORE_CHUNK_MAX_UIDS):
+            chunk = msg_ids[i:i + STORE_CHUNK_MAX_UIDS]
+            uid_set = ','.join(self.__asUid(m) for m in chunk)
+            typ = 'None'
+            try:
+                if use_move:
+                    typ, dat = self.connect_imap.uid('MOVE', uid_set, target_folder)
+                else:
+                    typ, dat = self.connect_imap.uid('COPY', uid_set, target_folder)
+                    if typ == 'OK':
+                        typ, dat = self.connect_imap.uid('STORE', uid_set,
+                                                         '+FLAGS.SILENT', '(\\Deleted)')
+                    if typ == 'OK':
+                        typ, dat = self.connect_imap.expunge()
+            except Exception as e:
+                logger.error('IMAP error bulk move %s user %s to %s, ex: %s',
+                             self.server, mail_user, target_folder, str(e))
+
+            if typ != 'OK':
+                count_error += len(chunk)
+
+        return count_error
+
+    def supportsMove(self):
+        return 'MOVE' in self.caps
+
+    def supportsLiteralPlus(self):
+        return self.use_literal_plus
+
+    def multiAppend(self, folder, items, mail_user=''):
+        """Append several messages with one MULTIAPPEND command (RFC 3502).
+
+        items is a list of (flag bitmask, body bytes) pairs. Every literal
+        goes out in the non-synchronizing {size+} form, so the whole batch
+        is a single write sharing one tag — no per-message tag or
+        continuation round-trip. Caller checks use_multiappend and
+        use_literal_plus first and drains the tag with collectTag.
+        Returns the tag, or None if the write failed.
+        """
+        conn = self.connect_imap
+        tag = conn._new_tag()
+        buf = bytearray(tag)
+        buf += ' APPEND {fld}'.format(fld=folder).encode('ascii')
+        for flags, body in items:
+            flag_part = '({f})'.format(f=decodeFlags(flags)) if flags else '()'
+            buf += ' {fp} {{{n}+}}\r\n'.format(fp=flag_part, n=len(body)).encode('ascii')
+            buf += body
+        buf += b'\r\n'
+        conn.tagged_commands[tag] = None
+        try:
+            conn.send(bytes(buf))
+        except Exception as e:
+            del conn.tagged_commands[tag]
+            logger.error('IMAP error multiappend %s folder %s user %s, ex: %s',
+                         self.server, folder, mail_user, str(e))
+            return None
+
+        return tag
+
+    def sendTagged(self, name, *args):
+        """Write one tagged command without waiting for its completion.
+
+        Returns the tag to pass to collectTag, or None if the write failed.
+        The tag is registered in imaplib's tagged_commands, so responses of
+        other in-flight tags read while draining are routed normally.
+        """
+        conn = self.connect_imap
+        tag = conn._new_tag()
+        parts = [tag, name.encode('ascii')]
+        parts.extend(a if isinstance(a, bytes) else a.encode('ascii') for a in args)
+        conn.tagged_commands[tag] = None
+        try:
+            conn.send(b' '.join(parts) + b'\r\n')
+        except Exception as e:
+            del conn.tagged_commands[tag]
+            logger.error('IMAP error send %s %s, ex: %s', name, self.server, str(e))
+            return None
+
+        return tag
+
+    def collectTag(self, name, tag):
+        """Wait for the tagged completion of a command sent by sendTagged."""
+        if tag is None:
+            return False
+
+        try:
+            typ, dat = self.connect_imap._command_complete(name, tag)
+        except Exception as e:
+            logger.error('IMAP error complete %s %s, ex: %s', name, self.server, str(e))
+            return False
+
+        return typ == 'OK'
+
+    def streamMessage(self, mail_imap_id):
+        """Fetch one message body as a stream of STREAM_CHUNK_SIZE chunks.
+
+        Returns (size, chunk generator) or (None, None) on failure. The
+        generator holds the connection until consumed to the end: after the
+        last chunk it reads the response trailer and the tagged completion,
+        so no other command may run on this connection in between.
+        """
+        conn = self.connect_imap
+        tag = self.sendTagged('UID', 'FETCH', self.__asUid(mail_imap_id), '(BODY.PEEK[])')
+        if tag is None:
+            return None, None
+
+        size = None
+        try:
+            while True:
+                line = conn.readline()
+                if not line or line.startswith(tag):
+                    break
+
+                m = cmp_fetch_literal.search(line)
+                if m and line.startswith(b'*'):
+                    size = int(m.group(1))
+                    break
+        except Exception as e:
+            logger.error('IMAP error stream fetch %s, ex: %s', self.server, str(e))
+
+        if size is None:
+            conn.tagged_commands.pop(tag, None)
+            logger.error('IMAP error stream fetch %s message id %s', self.server, mail_imap_id)
+            return None, None
+
+        def _chunks():
+            # one preallocated buffer for the whole body: readinto fills it
+            # in place, so the pump allocates nothing per chunk. Each yield
+            # is consumed (sent) before the next fill, which makes reuse
+            # safe. The compressed reader has no readinto and falls back.
+            readinto = getattr(conn.file, 'readinto', None)
+            view = memoryview(bytearray(STREAM_CHUNK_SIZE)) if readinto else None
+            remaining = size
+            while remaining > 0:
+                want = min(STREAM_CHUNK_SIZE, remaining)
+                if readinto:
+                    got = readinto(view[:want])
+                    if not got:
+                        break
+                    remaining -= got
+                    yield view[:got]
+                else:
+                    chunk = conn.read(want)
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            # closing ')' of the untagged FETCH, then the tagged completion
+            conn.readline()
+            self.collectTag('UID', tag)
+
+        return size, _chunks()
+
+    def appendMessageStreaming(self, folder, size, chunks, flags, mail_user=''):
+        """Append a message by pumping body chunks straight to the socket.
+
+        Announces the literal with {size+} when the server has LITERAL+,
+        otherwise waits for the continuation, then writes the chunks as they
+        arrive, so at most one chunk is buffered per message. Returns the
+        tag for collectTag, or None if the write failed.
+        """
+        conn = self.connect_imap
+        tag = conn._new_tag()
+        flag_part = '({f})'.format(f=decodeFlags(flags)) if flags else '()'
+        plus = '+' if self.supportsLiteralPlus() else ''
+        head = '{t} APPEND {fld} {fp} {{{n}{p}}}\r\n'.format(
+            t=tag.decode('ascii'), fld=folder, fp=flag_part, n=size, p=plus)
+        conn.tagged_commands[tag] = None
+        try:
+            conn.send(head.encode('ascii'))
+            if not plus:
+                line = conn.readline()
+                if not line.startswith(b'+'):
+                    raise conn.error('no continuation for append literal: %r' % line)
+
+            for chunk in chunks:
+                conn.send(chunk)
+            conn.send(b'\r\n')
+        except Exception as e:
+            conn.tagged_commands.pop(tag, None)
+            logger.error('IMAP error stream append %s user %s folder %s, ex: %s',
+                         self.server, mail_user, folder, str(e))
+            return None
+
+        return tag
+
+def secondsToStr(t):
+    m, s = divmod(t, 60)
+    h, m = divmod(m, 60)
+    return f"{int(h)}:{int(m):02d}:{s:06.3f}"
+
+
+def syncOneMailbox(user, current_mailbox, conn_pool, settings_imap):
+    """Sync one folder of a user on a borrowed (src, dst, cache) pool set.
+
+    Returns (append_messages, append_size_byte, error_updates) for the
+    folder; caller aggregates over all folders.
+    """
+    src_imap_conn, dst_imap_conn, cache = conn_pool.get()
+    try:
+        dst_imap_conn.createMailbox(current_mailbox)
+
+        # STATUS on both sides costs no SELECT; when it matches the
+        # snapshot recorded after the last clean sync the folder is
+        # skipped outright
+        src_status = None
+        if cache:
+            src_status = src_imap_conn.status(current_mailbox)
+            dst_status = dst_imap_conn.status(current_mailbox)
+            if src_status and dst_status:
+                sync_state = cache.getSyncState(user, current_mailbox)
+                if sync_state == (src_status.get('UIDVALIDITY'),
+                                  src_status.get('UIDNEXT'),
+                                  src_status.get('HIGHESTMODSEQ'),
+                                  dst_status.get('UIDVALIDITY'),
+                                  dst_status.get('UIDNEXT'),
+                                  dst_status.get('HIGHESTMODSEQ')):
+                    logger.info('Thread %s, folder %s unchanged, skipped',
+                                user, current_mailbox)
+                    return 0, 0, 0
+
+        # Fetch destination messages ID
+        logger.info('Thread %s, fetch messages ID from %s', user, current_mailbox)
+
+        src_res, src_msg = src_imap_conn.openFolder(current_mailbox, True)
+        dst_res, dst_msg = dst_imap_conn.openFolder(current_mailbox)
+        if not src_res or not dst_res:
+            if not src_res:
+                logger.error('Thread %s, error open src folder %s - %s', user, current_mailbox, src_msg)
+            else:
+                src_imap_conn.closeFolder()
+            if not dst_res:
+                logger.error('Thread %s, error open dst folder %s - %s', user, current_mailbox, dst_msg)
+            else:
+                dst_imap_conn.closeFolder()
+            return 0, 0, 0
+
+        filter_email = settings_imap.get('filter_email')
+        dst_uidvalidity, dst_uidnext = dst_imap_conn.getFolderUidState()
+        dst_message_ids = None
+        if cache and dst_uidvalidity:
+            cached_state = cache.getFolderState(user, current_mailbox)
+            if cached_state and cached_state[0] == dst_uidvalidity:
+                dst_message_ids = cache.loadMessages(user, current_mailbox)
+                if dst_uidnext and dst_uidnext > cached_state[1]:
+                    # only metadata of UIDs added since the last run
+                    dst_message_ids.update(dst_imap_conn.fetchHeadersBatch(
+                        ['{}:*'.format(cached_state[1])]))
+                logger.info('Thread %s, cache hit %s (%s cached messages)',
+                            user, current_mailbox, str(len(dst_message_ids)))
+
+        if dst_message_ids is None:
+            dst_message_ids = dst_imap_conn.fetchMetadataBulk(filter_email)
+
+        if cache and dst_uidvalidity:
+            cache.replaceFolder(user, current_mailbox, dst_uidvalidity,
+                                dst_uidnext or 0, dst_message_ids)
+
+        count_dst = len(dst_message_ids)
+
+        # secondary index (Message-ID hash, size) -> dst uid: a UIDVALIDITY
+        # reset or a prior partial sync can leave the same logical message
+        # under a new uid, and matching on it skips the body re-upload;
+        # conversely a same-id entry with another size is re-appended
+        dst_by_hash_size = {}
+        dst_uids = dst_message_ids.uids
+        dst_sizes = dst_message_ids.sizes
+        for dst_key, dst_idx in dst_message_ids.hash2idx.items():
+            if dst_key is not None:
+                dst_by_hash_size[(dst_key, dst_sizes[dst_idx])] = dst_uids[dst_idx]
+
+        src_message_ids = src_imap_conn.fetchMetadataBulk(filter_email)
+        count_all_crs = len(src_message_ids)
+
+        logger.info('Thread %s, start sync mail %s, count src:%s dst:%s',
+                    user, current_mailbox, str(count_all_crs), str(count_dst))
+
+        append_messages_folder = 0
+        append_size_folder = 0
+        count_src = 0
+        count_error_sync = 0
+        count_error_sync_flags = 0
+
+        # same-server relocation: a message the source has in this folder
+        # but the destination holds in another one is moved with UID MOVE
+        # instead of re-uploading its body (atomic and metadata-only)
+        moved_keys = set()
+        if cache and getattr(settings, 'same_server_move', False) \
+                and dst_imap_conn.supportsMove():
+            move_groups = collections.defaultdict(list)
+            for src_msg_id, src_idx in src_message_ids.hash2idx.items():
+                size_byte = src_message_ids.sizes[src_idx]
+                if src_msg_id is None \
+                        or (src_msg_id, size_byte) in dst_by_hash_size:
+                    continue
+                found = cache.findMessage(user, src_message_ids.raw_ids[src_idx],
+                                          size_byte, current_mailbox)
+                if found:
+                    move_groups[found[0]].append((found[1], src_msg_id))
+
+            for other_folder, moves in move_groups.items():
+                res, dat = dst_imap_conn.openFolder(other_folder, False)
+                if not res:
+                    logger.error('Thread %s, error open folder %s for move - %s',
+                                 user, other_folder, dat)
+                    continue
+                failed = dst_imap_conn.moveMessagesBulk(
+                    [move_uid for move_uid, _key in moves], current_mailbox, user)
+                count_error_sync += failed
+                if not failed:
+                    # MOVE keeps the flags, so the loop can skip these
+                    # messages entirely
+                    moved_keys.update(key for _uid, key in moves)
+
+            if move_groups:
+                logger.info('Thread %s, moved %d messages into %s',
+                            user, len(moved_keys), current_mailbox)
+                # put the sync folder back under the connection
+                dst_imap_conn.openFolder(current_mailbox)
+
+        # sliding window of pipelined tagged commands on the dst
+        # connection; nothing else may run on it while non-empty
+        pipeline = collections.deque()
+        pipeline_depth = getattr(settings, 'pipeline_depth', 16)
+        use_literal_plus = dst_imap_conn.use_literal_plus
+        # small messages are buffered and shipped K at a time with one
+        # MULTIAPPEND command; larger ones keep the streamed per-message path
+        multiappend_batch = max(1, getattr(settings, 'multiappend_batch', 16))
+        use_multiappend = dst_imap_conn.use_multiappend and use_literal_plus \
+            and multiappend_batch > 1
+        append_batch = []
+        flag_groups = collections.defaultdict(list)
+        # hoist the columns and bound methods the loop hits per message;
+        # the body stays at index loads, dict probes and calls
+        src_flags = src_message_ids.flags
+        src_uids = src_message_ids.uids
+        src_sizes = src_message_ids.sizes
+        src_raw_ids = src_message_ids.raw_ids
+        # one isEnabledFor check per folder; with DEBUG off the modulo can
+        # never hit, so the loop does no progress formatting at all
+        log_every = 1000 if logger.isEnabledFor(logging.DEBUG) else (1 << 30)
+        lookup_dst = dst_by_hash_size.get
+        stream_message = src_imap_conn.streamMessage
+        append_streaming = dst_imap_conn.appendMessageStreaming
+        multi_append = dst_imap_conn.multiAppend
+        collect_tag = dst_imap_conn.collectTag
+        pipeline_add = pipeline.append
+        pipeline_pop = pipeline.popleft
+        for src_msg_id, src_idx in src_message_ids.hash2idx.items():
+            count_src += 1
+            if moved_keys and src_msg_id in moved_keys:
+                continue
+
+            flag = src_flags[src_idx]
+            src_uid = src_uids[src_idx]
+            size_byte = src_sizes[src_idx]
+            raw_msgid = src_raw_ids[src_idx]
+            if src_msg_id is not None:
+                dst_uid = lookup_dst((src_msg_id, size_byte))
+            else:
+                # messages without a Message-ID can only match positionally
+                dst_uid = dst_message_ids.uidOf(None)
+
+            if dst_uid is None:
+                # without LITERAL+ the append has to read a
+                # continuation, which cannot be interleaved with
+                # pending tagged responses
+                while pipeline and not use_literal_plus:
+                    cmd_name, tag, weight = pipeline_pop()
+                    if not collect_tag(cmd_name, tag):
+                        if cmd_name == 'APPEND':
+                            count_error_sync += weight
+                        else:
+                            count_error_sync_flags += weight
+                        logger.error('Thread %s, error pipelined %s %s',
+                                     user, cmd_name, current_mailbox)
+
+                # stream the body src -> dst, one 64 KiB chunk in RAM
+                # at a time instead of the whole message
+                size_msg, msg_chunks = stream_message(src_uid)
+                if msg_chunks is None:
+                    count_error_sync += 1
+                    logger.error('Thread %s, error fetch %s message %s',
+                                 user, current_mailbox, raw_msgid)
+                    continue
+
+                append_messages_folder += 1
+                append_size_folder += size_byte
+                if use_multiappend and size_msg <= STREAM_CHUNK_SIZE:
+                    # chunks can be views of a reused buffer, so copy
+                    # while draining the generator
+                    body = bytearray()
+                    for msg_chunk in msg_chunks:
+                        body += msg_chunk
+                    append_batch.append((flag, bytes(body)))
+                    if len(append_batch) >= multiappend_batch:
+                        tag = multi_append(current_mailbox, append_batch, user)
+                        if tag is None:
+                            count_error_sync += len(append_batch)
+                        else:
+                            pipeline_add(('APPEND', tag, len(append_batch)))
+                        append_batch = []
+                else:
+                    tag = append_streaming(current_mailbox, size_msg, msg_chunks, flag, user)
+                    if tag is None:
+                        count_error_sync += 1
+                        # the append died mid-body: the unread literal,
+                        # trailer and tagged completion are still on the
+                        # src socket, so exhaust the generator or every
+                        # later command on that connection desyncs
+                        for _ in msg_chunks:
+                            pass
+                    else:
+                        pipeline_add(('APPEND', tag, 1))
+
+            elif flag:
+                # collect dst uids per flag string; one bulk STORE per
+                # group after the loop instead of one per message
+                flag_groups[flag].append(dst_uid)
+
+            # drain completed slots so at most pipeline_depth commands
+            # are in flight
+            while len(pipeline) >= pipeline_depth:
+                cmd_name, tag, weight = pipeline_pop()
+                if not collect_tag(cmd_name, tag):
+                    if cmd_name == 'APPEND':
+                        count_error_sync += weight
+                    else:
+                        count_error_sync_flags += weight
+                    logger.error('Thread %s, error pipelined %s %s',
+                                 user, cmd_name, current_mailbox)
+
+            if count_src % log_every == 0:
+                logger.debug('Thread %s, message processing %d%% (%d in %d)',
+                             user, 100 * count_src // count_all_crs,
+                             count_src, count_all_crs)
+
+        if append_batch:
+            tag = multi_append(current_mailbox, append_batch, user)
+            if tag is None:
+                count_error_sync += len(append_batch)
+            else:
+                pipeline_add(('APPEND', tag, len(append_batch)))
+            append_batch = []
+
+        while pipeline:
+            cmd_name, tag, weight = pipeline.popleft()
+            if not dst_imap_conn.collectTag(cmd_name, tag):
+                if cmd_name == 'APPEND':
+                    count_error_sync += weight
+                else:
+                    count_error_sync_flags += weight
+                logger.error('Thread %s, error pipelined %s %s',
+                             user, cmd_name, current_mailbox)
+
+        for group_flags, group_uids in flag_groups.items():
+            count_error_sync_flags += dst_imap_conn.updateMessagesBulk(
+                group_uids, group_flags, user)
+
+        logger.info('Thread %s, Appends to destination count:%s size:%s, count error:%s',
+                    user, str(append_messages_folder), str(append_size_folder),
+                    str(count_error_sync_flags + count_error_sync))
+
+        dst_imap_conn.closeFolder()
+        src_imap_conn.closeFolder()
+
+        if cache and src_status and not (count_error_sync or count_error_sync_flags):
+            # pair the pre-sync src snapshot with a fresh dst STATUS (our
+            # appends and stores moved its UIDNEXT/MODSEQ); src mail that
+            # arrived mid-sync breaks the match and forces a resync
+            dst_status = dst_imap_conn.status(current_mailbox)
+            if dst_status:
+                cache.saveSyncState(user, current_mailbox, src_status, dst_status)
+
+        return append_messages_folder, append_size_folder, \
+            count_error_sync_flags + count_error_sync
+    finally:
+        conn_pool.put((src_imap_conn, dst_imap_conn, cache))
+
+
+def runThreadSyncMail(user, settings_imap):
+    append_messages = 0
+    append_size_byte = 0
+    error_updates = 0
+
+    start_time = time.time()
+    logger.info('Thread %s start sync', user)
+
+    cache_path = getattr(settings, 'cache_path', None)
+    mailbox_parallel = max(1, getattr(settings, 'max_mailbox_parallel', 2))
+
+    # pool of logged-in (src, dst, cache) sets; each folder task borrows one,
+    # so folders of the user sync concurrently up to max_mailbox_parallel.
+    # The queue hands a set to one thread at a time, which also serializes
+    # access to its sqlite connection.
+    conn_pool = queue.Queue()
+    pool_size = 0
+    for _ in range(mailbox_parallel):
+        src_imap_conn = IMAPServer()
+        dst_imap_conn = IMAPServer()
+        if not src_imap_conn.connect(settings_imap.get('SERVER_IMAP_SOURCE')):
+            break
+        if not dst_imap_conn.connect(settings_imap.get('SERVER_IMAP_DESTINATION')):
+            break
+        if not (src_imap_conn.loginUser(user) and dst_imap_conn.loginUser(user)):
+            break
+
+        cache = MessageIdCache(cache_path) if cache_path else None
+        conn_pool.put((src_imap_conn, dst_imap_conn, cache))
+        pool_size += 1
+
+    if not pool_size:
+        return
+
+    src_imap_conn, dst_imap_conn, cache = conn_pool.get()
+    logger.info('Capability source: %s', src_imap_conn.capability())
+    logger.info('Capability source: %s', dst_imap_conn.capability())
+    src_list_folder = src_imap_conn.listFolders()
+    conn_pool.put((src_imap_conn, dst_imap_conn, cache))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=pool_size) as executor:
+        futures = [executor.submit(syncOneMailbox, user, current_mailbox,
+                                   conn_pool, settings_imap)
+                   for current_mailbox in src_list_folder]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                folder_messages, folder_size, folder_errors = future.result()
+            except Exception as e:
+                error_updates += 1
+                logger.error('Thread %s, mailbox sync failed: %s', user, str(e))
+                continue
+
+            append_messages += folder_messages
+            append_size_byte += folder_size
+            error_updates += folder_errors
+
+    while not conn_pool.empty():
+        src_imap_conn, dst_imap_conn, cache = conn_pool.get()
+        src_imap_conn.logOut()
+        dst_imap_conn.logOut()
+        if cache:
+            cache.close()
+
+    logger.info('Thread %s, Finish sync append message count:%s size:%s',
+                user, str(append_messages), str(append_size_byte))
+
+    second_execute = secondsToStr(time.time() - start_time)
+    return 'Finish Sync: {uSr}, append messages: {countmsg}, ' \
+           'size: {sZ} byte, error updated: {eUPD} , time executed: {tEx}'.format(uSr=user,
+                                                                                  countmsg=append_messages,
+                                                                                  eUPD=error_updates,
+                                                                                  sZ=append_size_byte,
+                                                                                  tEx=second_execute)
+
+
+async def _asyncConnectIMAP(config):
+    l_timeout = float(config.get('timeout', 30))
+    l_server = config.get('server')
+    l_port = config.get('port', 143)
+    l_secure = config.get('secure', 'None')
+
+    if 'SSL' in l_secure:
+        logger.info("Connecting to '%s' TCP port %s, SSL (asyncio)", l_server, str(l_port))
+        imap = aioimaplib.IMAP4_SSL(host=l_server, port=l_port, timeout=l_timeout)
+    else:
+        logger.info("Connecting to '%s' TCP port %s (asyncio)", l_server, str(l_port))
+        imap = aioimaplib.IMAP4(host=l_server, port=l_port, timeout=l_timeout)
+
+    await imap.wait_hello_from_server()
+    if 'TLS' in l_secure:
+        await imap.starttls()
+
+    l_login_user = '{user}*{master}'.format(user=config.get('login_user'), master=config.get('master_usr'))
+    res = await imap.login(l_login_user, config.get('master_pwd'))
+    if res.result != 'OK':
+        logger.error('IMAP connect ERROR: Host %s, user=%s - %s', l_server, config.get('login_user'), str(res.lines))
+        return None
+
+    return imap
+
+
+async def _asyncFetchMessageIds(imap, msg_ids, user, mailbox):
+    """Fetch metadata of all messages, pipelining the FETCH round-trips."""
+    message_ids = {}
+    tasks = [imap.fetch(mid.decode() if isinstance(mid, bytes) else str(mid), FETCH_MESSAGE_META)
+             for mid in msg_ids]
+    for task in asyncio.as_completed(tasks):
+        res = await task
+        if res.result != 'OK' or len(res.lines) < 2:
+            continue
+
+        msgid, flg, size_msg = parseMessageMeta(bytes(res.lines[0]), bytes(res.lines[1]))
+        mid = res.lines[0].split(b' ', 1)[0]
+        key = hashMessageId(msgid)
+        known = message_ids.get(key)
+        if known is None or size_msg != known[2]:
+            message_ids[key] = (flg, mid, size_msg, msgid)
+
+    logger.info('Thread %s, fetched %s messages ID from %s', user, str(len(message_ids)), mailbox)
+    return message_ids
+
+
+async def _asyncSyncMailbox(src_imap, dst_imap, mailbox, filter_email, user):
+    append_messages = 0
+    append_size_byte = 0
+    error_updates = 0
+
+    res = await dst_imap.create(mailbox)
+    src_res = await src_imap.select(mailbox)
+    dst_res = await dst_imap.select(mailbox)
+    if src_res.result != 'OK' or dst_res.result != 'OK':
+        logger.error('Thread %s, error open folder %s - src:%s dst:%s',
+                     user, mailbox, src_res.result, dst_res.result)
+        return append_messages, append_size_byte, error_updates
+
+    cmd_search = getCmdSearchMail(filter_email)
+    src_search = await src_imap.search(cmd_search)
+    dst_search = await dst_imap.search(cmd_search)
+    if src_search.result != 'OK' or dst_search.result != 'OK':
+        logger.error('Thread %s, error search folder %s', user, mailbox)
+        return append_messages, append_size_byte, error_updates
+
+    src_ids = src_search.lines[0].split()
+    dst_ids = dst_search.lines[0].split()
+
+    src_message_ids = await _asyncFetchMessageIds(src_imap, src_ids, user, mailbox)
+    dst_message_ids = await _asyncFetchMessageIds(dst_imap, dst_ids, user, mailbox)
+
+    logger.info('Thread %s, start sync mail %s, count src:%s dst:%s',
+                user, mailbox, str(len(src_message_ids)), str(len(dst_message_ids)))
+
+    for src_msg_id, msg_data in src_message_ids.items():
+        flags, src_uid, size_byte, raw_msgid = msg_data
+        if src_msg_id not in dst_message_ids:
+            res = await src_imap.fetch(src_uid.decode(), '(RFC822)')
+            if res.result != 'OK' or len(res.lines) < 2:
+                error_updates += 1
+                logger.error('Thread %s, error fetch %s message %s', user, mailbox, raw_msgid)
+                continue
+
+            res_append = await dst_imap.append(bytes(res.lines[1]), mailbox=mailbox,
+                                               flags=decodeFlags(flags) or None)
+            if res_append.result != 'OK':
+                error_updates += 1
+                logger.error('Thread %s, error append %s message %s', user, mailbox, raw_msgid)
+
+            append_messages += 1
+            append_size_byte += size_byte
+        else:
+            if flags:
+                dst_mid = dst_message_ids[src_msg_id][1].decode()
+                res_store = await dst_imap.store(dst_mid, '+FLAGS',
+                                                 '({f})'.format(f=decodeFlags(flags)))
+                if res_store.result != 'OK':
+                    error_updates += 1
+                    logger.error('Thread %s, error update %s flags message %s', user, mailbox,
+                                 raw_msgid)
+
+    await src_imap.close()
+    await dst_imap.close()
+    return append_messages, append_size_byte, error_updates
+
+
+async def sync_user_async(user, settings_imap):
+    """Asyncio worker: same job as runThreadSyncMail but with pipelined IMAP."""
+    append_messages = 0
+    append_size_byte = 0
+    error_updates = 0
+
+    start_time = time.time()
+    logger.info('Thread %s start sync', user)
+
+    src_config = dict(settings_imap.get('SERVER_IMAP_SOURCE'), login_user=user)
+    dst_config = dict(settings_imap.get('SERVER_IMAP_DESTINATION'), login_user=user)
+
+    src_imap = await _asyncConnectIMAP(src_config)
+    if not src_imap:
+        return
+
+    dst_imap = await _asyncConnectIMAP(dst_config)
+    if not dst_imap:
+        await src_imap.logout()
+        return
+
+    res = await src_imap.list('""', '*')
+    if res.result == 'OK':
+        for f in res.lines[:-1]:
+            m = cmp_list_mailbox.match(f.decode('UTF-8') if isinstance(f, (bytes, bytearray)) else f)
+            if not m:
+                continue
+
+            flags, delimiter, mailbox = m.groups()
+            if 'Noselect' in flags:
+                continue
+
+            cnt_append, cnt_size, cnt_err = await _asyncSyncMailbox(
+                src_imap, dst_imap, mailbox, settings_imap.get('filter_email'), user)
+            append_messages += cnt_append
+            append_size_byte += cnt_size
+            error_updates += cnt_err
+
+    await src_imap.logout()
+    await dst_imap.logout()
+
+    second_execute = secondsToStr(time.time() - start_time)
+    return 'Finish Sync: {uSr}, append messages: {countmsg}, ' \
+           'size: {sZ} byte, error updated: {eUPD} , time executed: {tEx}'.format(uSr=user,
+                                                                                  countmsg=append_messages,
+                                                                                  eUPD=error_updates,
+                                                                                  sZ=append_size_byte,
+                                                                                  tEx=second_execute)
+
+
+async def _asyncSyncAllUsers(user_list, settings_imap):
+    max_users = getattr(settings, 'MAX_CONCURRENT_USERS', settings.max_thread_sync_mail)
+    semaphore = asyncio.Semaphore(max_users)
+    results = {}
+
+    async def bounded_sync(item_user):
+        async with semaphore:
+            try:
+                results[item_user] = await sync_user_async(item_user, settings_imap)
+            except Exception as exc:
+                # keep the failure local so the TaskGroup does not cancel
+                # the remaining users
+                logger.error('%s generated an exception: %s', item_user, str(exc))
+                results[item_user] = exc
+
+    async with asyncio.TaskGroup() as tg:
+        for item_user in user_list:
+            tg.create_task(bounded_sync(item_user))
+
+    return results
+
+
+class main:
+    NAME = 'Sync iredadmin LDAP backend user'
+    VERSION = '0.1'
+
+    def __init__(self):
+        self.ldap_src = None
+        self.ldap_dst = None
+        self.src_imap_conn = None
+        self.dst_imap_conn = None
+        self.param_filter_email = {}
+
+    def __del__(self):
+        self.ldap_src = None
+        self.ldap_dst = None
+        self.src_imap_conn = None
+        self.dst_imap_conn = None
+
+    def run(self):
+        logger.info('Start sync iRedMail')
+
+        # Instantiate the parser
+        parser = argparse.ArgumentParser(description='Sync user ldap backend iredadmin')
+        subparser = parser.add_subparsers(help='List of commands')
+
+        parser.add_argument('-d', '--domainsync', help='Sync domain [only domain]', nargs='?', const='*', type=str)
+        parser.add_argument('-u', '--usersync', help='Sync user [only user]', nargs='?', const='*', type=str)
+        parser.add_argument('-m', '--mailsync', help='sync mail on imap protocol', action='store_true')
+
+        parser_filter = subparser.add_parser('filter', help='parameters filter email sync')
+        parser_filter.add_argument('age', type=str, choices=['min', 'max'], help='type age email')
+        parser_filter.add_argument('countage', type=int, help='count days age mail (min or max)')
+
+        program_args = parser.parse_args()
+        param_usernsync = program_args.usersync
+        param_domainsync = program_args.domainsync
+        param_mailsync = program_args.mailsync
+        vars_param = vars(program_args)
+        if vars_param.get('age'):
+            if program_args.age == 'min':
+                self.param_filter_email['minage'] = vars_param.get('countage')
+            else:
+                self.param_filter_email['maxage'] = vars_param.get('countage')
+
+        if param_domainsync or param_usernsync:
+            self.ldap_src = LdapServer()
+            res = self.ldap_src.connect(settings.SERVER_SOURCE)
+            if not res[0]:
+                logger.error('Error connect to ldap server source : %s' % res[1])
+
+            self.ldap_dst = LdapServer()
+            res = self.ldap_dst.connect(settings.SERVER_DESTINATION)
+            if not res[0]:
+                logger.error('Error connect to ldap server destination : %s' % res[1])
+
+            if param_domainsync:
+                self.__syncDomain(param_domainsync)
+            else:
+                param_domainsync = '*'
+
+            if param_usernsync:
+                self.__syncUsers(param_domainsync, param_usernsync)
+
+            logger.info(self.ldap_src)
+            logger.info(self.ldap_dst)
+
+        if param_mailsync:
+            if not param_usernsync:
+                param_usernsync = '*'
+            self.__syncIMAPEmail(param_domainsync, param_usernsync)
+
+    def __syncDomain(self, domain_sync):
+        # sync domain
+        if domain_sync == '*':
+            src_domains = self.ldap_src.getDomainList()
+        else:
+            src_domains = self.ldap_src.getDomain(domain_sync)
+
+        count_domain = 0
+        for src_domain in src_domains:
+            count_domain += 1
+            attr = src_domain['attributes']
+            dn = self.ldap_src.getDomainNameFromFullDN(src_domain['dn'])
+            logger.info('Sync domain : %s' % dn)
+            resultCheck = self.ldap_dst.checkDomain(dn, attr)
+            if resultCheck[0] == 'MODIFY':
+                self.ldap_dst.updateDomain(resultCheck[1], resultCheck[2])
+                logger.info('Modify attribute domain %s - %s', str(resultCheck[1]), str(resultCheck[2]))
+            elif resultCheck[0] == 'ADD':
+                self.ldap_dst.addDomain(resultCheck[1], resultCheck[2])
+                logger.info('Create domain %s - %s', str(resultCheck[1]), str(resultCheck[2]))
+
+        if count_domain == 0:
+            logger.warning('Source LDAP not contains domain list status in enabled')
+
+    def __syncUsers(self, domain, user):
+        # one listing of the destination replaces the per-user lookup the
+        # check used to do, halving LDAP traffic on every run
+        dst_users = self.ldap_dst.loadUsers(domain)
+        for src_user in self.ldap_src.getUserList(domain):
+            dn_mail, usr_mail = self.ldap_src.getUserMailNameFromFullDN(src_user['dn'])
+            src_attr = src_user['attributes']
+
+            if user and user != '*' and usr_mail != user:
+                continue
+
+            logger.info('Sync user: %s', usr_mail)
+            cached_entry = dst_users.get(usr_mail.lower())
+            if cached_entry is None:
+                if not self.ldap_dst.is_email(usr_mail):
+                    continue
+                resultCheck = ('ADD', usr_mail, src_attr)
+            else:
+                resultCheck = self.ldap_dst.checkUser(usr_mail, src_attr, cached_entry=cached_entry)
+
+            if resultCheck[0] == 'MODIFY':
+                logger.info('Modify user : %s - %s', str(resultCheck[1]), str(resultCheck[2]))
+                self.ldap_dst.updateUser(resultCheck[1], resultCheck[2])
+            elif resultCheck[0] == 'ADD':
+                logger.info('Create user : %s - %s', str(resultCheck[1]), str(resultCheck[2]))
+                self.ldap_dst.addUser(resultCheck[1], resultCheck[2]
+                                      , settings.SERVER_DESTINATION)
+
+    def __syncIMAPEmail(self, domain, user):
+        # The specified user has advantage over the domain
+        logger.info('===================Start sync mail============================')
+
+        if not user or user == '*':
+            # stream straight from the paged LDAP search; the full account
+            # list never has to exist at once on the thread path
+            def _iterUsers():
+                for item_user_list in self.ldap_src.getUserList(domain):
+                    dn_mail, usr_mail = self.ldap_src.getUserMailNameFromFullDN(item_user_list['dn'])
+                    if usr_mail:
+                        yield usr_mail
+
+            user_iter = _iterUsers()
+        else:
+            user_iter = iter([user])
+
+        setting_thread = {
+            'SERVER_IMAP_SOURCE': settings.SERVER_IMAP_SOURCE,
+            'SERVER_IMAP_DESTINATION': settings.SERVER_IMAP_DESTINATION,
+            'filter_email': self.param_filter_email
+        }
+
+        # only users whose sync failed are retained for the final recap;
+        # successes are logged as they complete and dropped
+        failed_users = []
+
+        # the asyncio engine is opt-in: merely having aioimaplib installed
+        # must not bypass the thread path and its cache/pipelining/
+        # streaming machinery
+        if aioimaplib and getattr(settings, 'use_async_mail_sync', False):
+            user_list = list(user_iter)
+            r_async = asyncio.run(_asyncSyncAllUsers(user_list, setting_thread))
+            logger.info('===================Finish all sync============================')
+            for item_user in user_list:
+                result_sync = r_async.get(item_user)
+                if isinstance(result_sync, Exception):
+                    logger.error('%s generated an exception: %s', item_user, str(result_sync))
+                    failed_users.append(item_user)
+                else:
+                    logger.info('%s [%s]:%s', item_user, result_sync is not None, result_sync)
+            if failed_users:
+                logger.error('these users failed: %s', ', '.join(failed_users))
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=settings.max_thread_sync_mail) as executor:
+            # keep at most max_workers futures alive: each completion is
+            # logged and dropped, then the slot is refilled from the iterator
+            pending = {}
+
+            def submit_next():
+                item_user = next(user_iter, None)
+                if item_user is None:
+                    return False
+
+                pending[executor.submit(runThreadSyncMail, user=item_user,
+                                        settings_imap=setting_thread)] = item_user
+                return True
+
+            for _ in range(settings.max_thread_sync_mail):
+                if not submit_next():
+                    break
+
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    user_sync = pending.pop(future)
+                    try:
+                        result_sync = future.result()
+                    except Exception as exc:
+                        logger.error('%s generated an exception: %s', user_sync, str(exc))
+                        failed_users.append(user_sync)
+                    else:
+                        logger.info('%s [%s]:%s', user_sync, result_sync is not None, result_sync)
+                    submit_next()
+
+        logger.info('===================Finish all sync============================')
+        if failed_users:
+            logger.error('these users failed: %s', ', '.join(failed_users))
+
+
+if __name__ == '__main__':
+    app = main()
+    app.run()
+    sys.exit(0)